@@ -0,0 +1,340 @@
+"""Data-pipeline throughput benchmark for `MarioDataset`.
+
+Builds a synthetic recording set (frames, `action.pkl` and `meta.json` laid
+out like the server records them) and loads it through `MarioDataset` and a
+`DataLoader`, sweeping the storage format, the amount of workers, the batch
+size and the frame transform. Every case runs in a fresh interpreter so its
+peak memory is its own. Writes a JSON report that can be compared between
+commits, and exits with an error when a case regressed past `--threshold`.
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from itertools import islice, product
+
+import numpy as np
+from PIL import Image
+
+from utils import get_commit
+
+
+# storage format name -> PNG compression level (the server saves with PIL's default, 6)
+FORMATS = {"png-0": 0, "png-1": 1, "png-6": 6, "png-9": 9}
+TRANSFORMS = ["to_tensor", "resize", "grayscale"]
+
+SCRIPT = """
+import json
+from bench_data import load_case
+print(json.dumps(load_case(**{case!r})))
+"""
+
+
+def synthetic_frames(length: int, shape: tuple[int, int, int], seed: int) -> np.ndarray:
+    """Frames of a side-scrolling level: sky, ground and blocks scrolling by, plus a sprite.
+
+    Flat colours compress like the emulator's frames, unlike random noise.
+
+    Args:
+        length (int): amount of frames
+        shape (tuple[int, int, int]): height, width and channels of a frame
+        seed (int): random seed
+
+    Returns:
+        np.ndarray: frames (length, height, width, channels)
+    """
+    rng = np.random.default_rng(seed)
+    h, w, c = shape
+    level = np.empty((h, w + 2 * length, c), dtype=np.uint8)
+    level[:] = (92, 148, 252)[:c]
+    level[-h // 8:] = (200, 76, 12)[:c]
+    for _ in range(level.shape[1] // 32):
+        x = int(rng.integers(0, level.shape[1] - 16))
+        y = int(rng.integers(h // 4, h - h // 8 - 16))
+        level[y:y + 16, x:x + 16] = rng.integers(0, 256, c, dtype=np.uint8)
+
+    frames = np.empty((length, h, w, c), dtype=np.uint8)
+    for t in range(length):
+        frames[t] = level[:, 2 * t:2 * t + w]
+        y = h - h // 8 - 16 - int(abs(np.sin(t / 10)) * h // 4)
+        frames[t, y:y + 16, w // 3:w // 3 + 16] = (248, 56, 0)[:c]
+    return frames
+
+
+def make_recordings(
+    path: str,
+    episodes: int,
+    length: int,
+    compression: int,
+    shape: tuple[int, int, int] = (240, 256, 3),
+    seed: int = 0
+) -> list[str]:
+    """Write a synthetic recording set.
+
+    Args:
+        path (str): recordings root
+        episodes (int): amount of episodes
+        length (int): frames per episode
+        compression (int): PNG compression level
+        shape (tuple[int, int, int], optional): frame shape. Defaults to (240, 256, 3).
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list[str]: episode folders
+    """
+    rng = np.random.default_rng(seed)
+    folders = []
+    for episode in range(episodes):
+        folder = os.path.join(path, str(episode), "")
+        os.makedirs(folder, exist_ok=True)
+        for i, frame in enumerate(synthetic_frames(length, shape, seed + episode)):
+            Image.fromarray(frame).save(f"{folder}{i}.png", compress_level=compression)
+        with open(f"{folder}action.pkl", "wb") as f:
+            pickle.dump([int(action) for action in rng.integers(0, 7, length)], f)
+        with open(f"{folder}meta.json", "w") as f:
+            json.dump({"session": "synthetic", "action_repeat": 1}, f)
+        folders.append(folder)
+    return folders
+
+
+def folder_size(folders: list[str]) -> int:
+    """Bytes of the files in the folders.
+
+    Args:
+        folders (list[str]): folders
+
+    Returns:
+        int: total size
+    """
+    return sum(
+        entry.stat().st_size
+        for folder in folders
+        for entry in os.scandir(folder)
+        if entry.is_file()
+    )
+
+
+def peak_memory(children: bool = False) -> float:
+    """Peak resident memory, in MiB. Unix only, 0 elsewhere.
+
+    Args:
+        children (bool, optional): of the finished child processes (the largest one)
+            instead of this process. Defaults to False.
+
+    Returns:
+        float: peak resident memory
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    ).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def build_transform(name: str):
+    """Frame transform of a case.
+
+    Args:
+        name (str): one of `TRANSFORMS`
+
+    Returns:
+        transforms.Compose: transform given to `MarioDataset`
+    """
+    from torchvision import transforms
+
+    match name:
+        case "to_tensor":
+            return transforms.Compose([transforms.ToTensor()])
+        case "resize":
+            return transforms.Compose([transforms.Resize((84, 84)), transforms.ToTensor()])
+        case "grayscale":
+            return transforms.Compose([
+                transforms.Grayscale(),
+                transforms.Resize((84, 84)),
+                transforms.ToTensor(),
+            ])
+    raise ValueError(f"Unknown transform {name}")
+
+
+def load_case(
+    folders: list[str],
+    workers: int,
+    batch_size: int,
+    transform: str,
+    batches: int
+) -> dict[str, float]:
+    """Load batches of the recordings like `train.py` does. Runs in the case's interpreter.
+
+    Args:
+        folders (list[str]): episode folders
+        workers (int): DataLoader workers
+        batch_size (int): samples per batch
+        transform (str): one of `TRANSFORMS`
+        batches (int): batches to load, at most one epoch
+
+    Returns:
+        dict[str, float]: timings and memory of the case
+    """
+    from torch.utils.data import DataLoader
+    from train import MarioDataset
+
+    baseline = peak_memory()
+    start = time.perf_counter()
+    dataset = MarioDataset(folders, transform=build_transform(transform))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=workers)
+    built = time.perf_counter()
+
+    iterator = iter(loader)
+    next(iterator)
+    first = time.perf_counter()
+    loaded = sum(1 for _ in islice(iterator, batches - 1))
+    end = time.perf_counter()
+    # joins the workers, so their peak shows up in RUSAGE_CHILDREN
+    del iterator
+
+    samples = min(loaded * batch_size, len(dataset) - batch_size)
+    return {
+        "dataset_s": built - start,
+        "first_batch_s": first - built,
+        "samples_per_s": samples / max(end - first, 1e-9),
+        "batches": loaded + 1,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_memory(),
+        "worker_peak_rss_mb": peak_memory(children=True),
+    }
+
+
+def run_case(
+    folders: list[str],
+    workers: int,
+    batch_size: int,
+    transform: str,
+    batches: int
+) -> dict[str, float]:
+    """Run one case in a fresh interpreter.
+
+    Args:
+        folders (list[str]): episode folders
+        workers (int): DataLoader workers
+        batch_size (int): samples per batch
+        transform (str): one of `TRANSFORMS`
+        batches (int): batches to load
+
+    Returns:
+        dict[str, float]: timings and memory of the case
+    """
+    case = {
+        "folders": folders,
+        "workers": workers,
+        "batch_size": batch_size,
+        "transform": transform,
+        "batches": batches,
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(case=case)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        check=True
+    ).stdout.decode()
+    return json.loads(output.strip().split("\n")[-1])
+
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> list[tuple]:
+    """Print the relative change between two reports.
+
+    Args:
+        old (dict): baseline report
+        new (dict): current report
+        threshold (float, optional): relative change counted as a regression. Defaults to 0.1.
+
+    Returns:
+        list[tuple]: cases that regressed
+    """
+    def key(result):
+        return result["format"], result["workers"], result["batch_size"], result["transform"]
+
+    # metric -> whether higher is better
+    metrics = {"samples_per_s": True, "first_batch_s": False, "peak_rss_mb": False}
+    baseline = {key(result): result for result in old["results"]}
+    regressions = []
+    print(f"Comparing {old['commit']} -> {new['commit']}")
+    for result in new["results"]:
+        previous = baseline.get(key(result))
+        if previous is None:
+            continue
+        changes = []
+        for metric, higher in metrics.items():
+            change = (result[metric] - previous[metric]) / max(previous[metric], 1e-9)
+            changes.append(f"{metric}: {change:+.1%}")
+            if (-change if higher else change) > threshold:
+                regressions.append(key(result))
+        print(f"{key(result)} " + ", ".join(changes))
+    if len(regressions) > 0:
+        print(f"{len(set(regressions))} cases regressed more than {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--episodes", type=int, default=4)
+    parser.add_argument("--length", type=int, default=500, help="frames per episode")
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=list(FORMATS))
+    parser.add_argument("--workers", nargs="+", type=int, default=[0, 2, 4])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[4, 32])
+    parser.add_argument("--transforms", nargs="+", default=TRANSFORMS, choices=TRANSFORMS)
+    parser.add_argument("--batches", type=int, default=100, help="batches per case")
+    parser.add_argument("--output", default="./benchmark_results/data/")
+    parser.add_argument("--compare", default=None, help="report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = {
+        "commit": get_commit(),
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "episodes": args.episodes,
+        "length": args.length,
+        "batches": args.batches,
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory() as root:
+        for name in args.formats:
+            start = time.perf_counter()
+            folders = make_recordings(os.path.join(root, name), args.episodes, args.length, FORMATS[name])
+            size = folder_size(folders) / (1 << 20)
+            print(f"{name}: {size:.1f}MiB written in {time.perf_counter() - start:.1f}s")
+            for workers, batch_size, transform in product(args.workers, args.batch_sizes, args.transforms):
+                result = {
+                    "format": name,
+                    "workers": workers,
+                    "batch_size": batch_size,
+                    "transform": transform,
+                    "size_mb": size,
+                    **run_case(folders, workers, batch_size, transform, args.batches),
+                }
+                print(json.dumps(result))
+                report["results"].append(result)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, f"{report['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved at {path}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            if len(compare(json.load(f), report, args.threshold)) > 0:
+                sys.exit(1)
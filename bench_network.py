@@ -0,0 +1,432 @@
+"""Load-test and benchmark for the server/client protocol.
+
+Starts scripted servers on localhost and drives them with synthetic viewers that
+speak the same protocol as `Client`. Sweeps connection modes, frame sizes and
+viewer counts, and writes a JSON report that can be compared between commits.
+"""
+from itertools import product
+from multiprocessing.connection import Connection as Pipe
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from client import Client
+from inputs import InputState
+from profiling import Metrics
+from server import Server
+from tracing import LatencyTracer
+from utils import ACTIONS, Connection, get_commit
+
+
+class SyntheticEnvironment:
+    """Stand-in for the Mario environment that cycles through random frames.
+
+    Parameters:
+        shape (tuple[int, int, int]): shape of the frames.
+        frames (np.ndarray): pre-generated frames, so stepping costs nothing.
+        index (int): index of the current frame.
+    """
+
+    def __init__(self, shape: tuple[int, int, int] = (240, 256, 3), seed: int = 0):
+        """Synthetic environment.
+
+        Args:
+            shape (tuple[int, int, int], optional): frame shape. Defaults to (240, 256, 3).
+            seed (int, optional): seed for the frames. Defaults to 0.
+        """
+        self.shape = shape
+        rng = np.random.default_rng(seed)
+        self.frames = rng.integers(0, 256, size=(8, *shape), dtype=np.uint8)
+        self.index = 0
+
+    def reset(self) -> np.ndarray:
+        """Reset the environment.
+
+        Returns:
+            np.ndarray: first frame
+        """
+        self.index = 0
+        return self.frames[self.index]
+
+    def step(self, action: int) -> tuple[np.ndarray, float, bool, bool, dict]:
+        """Step the environment. Never terminates.
+
+        Args:
+            action (int): action (ignored)
+
+        Returns:
+            tuple[np.ndarray, float, bool, bool, dict]: gymnasium step output
+        """
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index], 0.0, False, False, {"flag_get": False}
+
+    @property
+    def unwrapped(self) -> "SyntheticEnvironment":
+        return self
+
+    @property
+    def ram(self) -> np.ndarray:
+        """Stand-in for the NES RAM, used for the checksums."""
+        return self.frames[self.index, 0]
+
+
+class CountingSocket:
+    """Socket proxy that counts the bytes sent and received.
+
+    Parameters:
+        sock (socket.socket): wrapped socket
+        sent (int): bytes sent so far
+        received (int): bytes received so far
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sent = 0
+        self.received = 0
+
+    def send(self, data: bytes) -> int:
+        self.sent += len(data)
+        return self.sock.send(data)
+
+    def recv(self, size: int) -> bytes:
+        data = self.sock.recv(size)
+        self.received += len(data)
+        return data
+
+    def __getattr__(self, name: str):
+        return getattr(self.sock, name)
+
+
+class ScriptedServer(Server):
+    """Headless `Server` driven by a scripted player.
+
+    Skips the Tk window and the keyboard/joypad listeners, binds to an
+    ephemeral port on localhost and replaces the pressed keys with a fixed
+    action script. The protocol code (`connect`, `send_frame`, `step`) is the
+    one from `Server`.
+    """
+
+    def __init__(
+        self,
+        connection_type: Connection,
+        shape: tuple[int, int, int],
+        timeout: float,
+        action_repeat: int = 1,
+        seed: int = 0,
+        handoff: Pipe = None
+    ):
+        """Scripted server.
+
+        Args:
+            connection_type (Connection): protocol mode
+            shape (tuple[int, int, int]): frame shape
+            timeout (float): time between player ticks
+            action_repeat (int, optional): frames each action is repeated for. Defaults to 1.
+            seed (int, optional): seed for the action script and the frames. Defaults to 0.
+            handoff (Pipe, optional): pipe viewers are handed over through, like a session of
+                `sessions.SessionManager`. Defaults to None (listen on an ephemeral port).
+        """
+        self.HOST = "127.0.0.1"
+        self.PORT = 0
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.handoff = handoff
+        self.metrics = Metrics("server")
+        self.profiler = None
+
+        self.done = False
+        self.human = True
+        self.inputs = InputState()
+        self.frame_trace = None
+        self.tracer = LatencyTracer("server", log_every=None)
+        self.closing = False
+        self.connection_type = connection_type
+        self.action_repeat = action_repeat
+        self.history = bytearray()
+        self.checkpoint = (0, None)
+        self.resets = 0
+        self.frames = 0
+        self.state_lock = threading.Lock()
+        self.env_ready = threading.Event()
+        self.env_ready.set()
+
+        self.record = False
+        self.agent_actions = []
+        self.agent_index = 0
+        self.connections = 0
+        self.viewers = []
+        self.max_viewers = 1
+        self.player = "human"
+        self.timeout = timeout
+        self.script = np.random.default_rng(seed).integers(0, len(ACTIONS), size=1024)
+        self.script_index = 0
+
+        self.environment = SyntheticEnvironment(shape, seed)
+        self.reset()
+
+        self.open_socket()
+        self.PORT = self.s.getsockname()[1]
+
+        self.threads = []
+        for target in (self.connect, self.step):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get_action_from_pressed_keys(self) -> int:
+        """Get the next action of the script.
+
+        Returns:
+            int: action
+        """
+        action = int(self.script[self.script_index % len(self.script)])
+        self.script_index += 1
+        return action
+
+    def stop(self) -> None:
+        """Stop the player and the listening socket."""
+        self.closing = True
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.s.close()
+
+
+class SyntheticViewer(Client):
+    """Headless `Client` that requests frames as fast as the server serves them."""
+
+    def __init__(
+        self,
+        port: int,
+        connection_type: Connection,
+        shape: tuple[int, int, int],
+        seed: int = 0
+    ):
+        """Synthetic viewer.
+
+        Args:
+            port (int): port of the scripted server
+            connection_type (Connection): protocol mode
+            shape (tuple[int, int, int]): frame shape
+            seed (int, optional): seed of the scripted server, so the emulators (and their
+                checksums) match. Defaults to 0.
+        """
+        self.HOST = "127.0.0.1"
+        self.PORT = port
+        self.session = None
+        self.s = CountingSocket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        self.buttons = False
+        self.connection_type = connection_type
+        self.tracer = LatencyTracer("viewer", log_every=None)
+        self.clock_offset = 0.0
+        self.trace = None
+        self.timestep = 0
+        self.action_repeat = 1
+        self.interval = 0.0
+        self.repeats = 0
+        self.last_action = 0
+        self.fetch = None
+        self.env = SyntheticEnvironment(shape, seed)
+        self.env_ready = threading.Event()
+        self.env_ready.set()
+        self.frame = self.env.reset()
+        self.connect()
+
+    def display_options(self, label: str) -> None:
+        """There are no buttons to show, just flag the end of the episode."""
+        self.buttons = True
+
+    def close(self, server: bool = False) -> None:
+        """Closes the connection.
+
+        Args:
+            server (bool, optional): Whether the server closed the connection. Defaults to False.
+        """
+        if not server:
+            self.s.send(json.dumps({"action": "close"}).encode())
+            self.s.recv(self.BUFFER_SIZE)
+        self.s.close()
+
+
+def run_viewer(
+    port: int,
+    mode: int,
+    shape: tuple[int, int, int],
+    duration: float,
+    seed: int = 0
+) -> dict[str, list[float]]:
+    """Request frames for `duration` seconds and collect per frame measurements.
+
+    Args:
+        port (int): port of the scripted server
+        mode (int): `Connection` value
+        shape (tuple[int, int, int]): frame shape
+        duration (float): seconds to run
+        seed (int, optional): seed of the scripted server. Defaults to 0.
+
+    Returns:
+        dict[str, list[float]]: latencies (s), bytes per frame and viewer CPU time (s)
+    """
+    viewer = SyntheticViewer(port, Connection(mode), shape, seed)
+    latencies, sizes = [], []
+
+    cpu = time.process_time()
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        transferred = viewer.s.sent + viewer.s.received
+        start = time.perf_counter()
+        viewer.frame = viewer.request_frame()
+        latencies.append(time.perf_counter() - start)
+        sizes.append(viewer.s.sent + viewer.s.received - transferred)
+    cpu = time.process_time() - cpu
+
+    viewer.close()
+    return {"latencies": latencies, "sizes": sizes, "cpu": cpu}
+
+
+def run_case(
+    mode: Connection,
+    shape: tuple[int, int, int],
+    viewers: int,
+    duration: float,
+    timeout: float,
+    action_repeat: int,
+    pool: multiprocessing.Pool
+) -> dict[str, any]:
+    """Run one configuration of the sweep.
+
+    Each viewer gets its own scripted server, as each booth runs one `Server`
+    per viewer.
+
+    Args:
+        mode (Connection): protocol mode
+        shape (tuple[int, int, int]): frame shape
+        viewers (int): amount of synthetic viewers
+        duration (float): seconds to run
+        timeout (float): time between player ticks
+        action_repeat (int): frames each action is repeated for
+        pool (multiprocessing.Pool): pool where the viewers run
+
+    Returns:
+        dict[str, any]: summary for this configuration
+    """
+    servers = [
+        ScriptedServer(mode, shape, timeout, action_repeat, seed)
+        for seed in range(viewers)
+    ]
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    results = pool.starmap(
+        run_viewer,
+        [(server.PORT, mode.value, shape, duration, seed) for seed, server in enumerate(servers)]
+    )
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    for server in servers:
+        server.stop()
+
+    latencies = np.concatenate([result["latencies"] for result in results]) * 1000
+    sizes = np.concatenate([result["sizes"] for result in results])
+    return {
+        "mode": mode.name,
+        "height": shape[0],
+        "width": shape[1],
+        "viewers": viewers,
+        "frames": int(latencies.shape[0]),
+        "fps_per_viewer": float(latencies.shape[0] / elapsed / viewers),
+        "bytes_per_frame": float(sizes.mean()),
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "server_cpu_per_viewer": float(cpu / elapsed / viewers),
+        "viewer_cpu": float(np.mean([result["cpu"] for result in results]) / elapsed),
+    }
+
+
+def compare(old: dict, new: dict) -> None:
+    """Print the relative change between two reports.
+
+    Args:
+        old (dict): baseline report
+        new (dict): current report
+    """
+    def key(result):
+        return result["mode"], result["height"], result["width"], result["viewers"]
+
+    baseline = {key(result): result for result in old["results"]}
+    metrics = ["fps_per_viewer", "bytes_per_frame", "latency_p50_ms", "latency_p99_ms"]
+    print(f"Comparing {old['commit']} -> {new['commit']}")
+    for result in new["results"]:
+        previous = baseline.get(key(result))
+        if previous is None:
+            continue
+        changes = [
+            f"{metric}: {(result[metric] - previous[metric]) / max(previous[metric], 1e-9):+.1%}"
+            for metric in metrics
+        ]
+        print(f"{key(result)} " + ", ".join(changes))
+
+
+def parse_shape(shape: str) -> tuple[int, int, int]:
+    height, width = shape.lower().split("x")
+    return int(height), int(width), 3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["FRAME", "ACTION"])
+    parser.add_argument("--sizes", nargs="+", default=["240x256", "120x128"])
+    parser.add_argument("--viewers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=1/40)
+    parser.add_argument("--action-repeat", type=int, default=1)
+    parser.add_argument("--output", default="./benchmark_results/network/")
+    parser.add_argument("--compare", default=None, help="report to compare against")
+    args = parser.parse_args()
+
+    report = {
+        "commit": get_commit(),
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "duration": args.duration,
+        "timeout": args.timeout,
+        "action_repeat": args.action_repeat,
+        "results": [],
+    }
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(max(args.viewers)) as pool:
+        for mode, size, viewers in product(args.modes, args.sizes, args.viewers):
+            result = run_case(
+                Connection[mode.upper()],
+                parse_shape(size),
+                viewers,
+                args.duration,
+                args.timeout,
+                args.action_repeat,
+                pool
+            )
+            print(json.dumps(result))
+            report["results"].append(result)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, f"{report['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved at {path}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report)
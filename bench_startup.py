@@ -0,0 +1,150 @@
+"""Startup-time benchmark for the environment factory and the server.
+
+Every run happens in a fresh interpreter, so it includes the imports that a
+relaunched booth station pays. The server runs headless, and is timed until
+its socket listens and until its environment is ready. Writes a JSON report
+that can be compared between commits.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from utils import get_commit
+
+
+SCRIPT = """
+import json
+import time
+start = time.perf_counter()
+from utils import create_environment
+imported = time.perf_counter()
+env = create_environment({env_name!r})
+created = time.perf_counter()
+env.reset()
+reset = time.perf_counter()
+env.reset()
+restored = time.perf_counter()
+print(json.dumps({{
+    "import_s": imported - start,
+    "create_environment_s": created - imported,
+    "first_reset_s": reset - created,
+    "reset_s": restored - reset,
+    "total_s": reset - start,
+}}))
+"""
+
+SERVER_SCRIPT = """
+import json
+import time
+start = time.perf_counter()
+from server import Server
+imported = time.perf_counter()
+stamps = {{}}
+
+
+class Probe(Server):
+    def open_socket(self):
+        super().open_socket()
+        stamps["listening_s"] = time.perf_counter() - start
+
+    def build_environment(self, env_name):
+        super().build_environment(env_name)
+        stamps["environment_ready_s"] = time.perf_counter() - start
+        self.closing = True
+
+
+try:
+    Probe(
+        {env_name!r}, record=False, action_repeat=1, metrics=False, profile=False,
+        host="127.0.0.1", port=0, player="human", joystick=None,
+        keyboard_input=False, window=False
+    )
+except SystemExit:
+    pass
+print(json.dumps({{"import_s": imported - start, **stamps}}))
+"""
+
+
+def measure(env_name: str, script: str = SCRIPT) -> dict[str, float]:
+    """Measure one startup in a fresh interpreter.
+
+    Args:
+        env_name (str): gym environment name
+        script (str, optional): startup to measure, SCRIPT or SERVER_SCRIPT. Defaults to SCRIPT.
+
+    Returns:
+        dict[str, float]: seconds spent in each startup stage
+    """
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", script.format(env_name=env_name)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        check=True
+    ).stdout.decode()
+    result = json.loads(output.strip().split("\n")[-1])
+    result["process_s"] = time.perf_counter() - start
+    return result
+
+
+def compare(old: dict, new: dict) -> None:
+    """Print the relative change between two reports.
+
+    Args:
+        old (dict): baseline report
+        new (dict): current report
+    """
+    print(f"Comparing {old['commit']} -> {new['commit']}")
+    for prefix, median in (("", "median"), ("server ", "server_median")):
+        for metric, value in new.get(median, {}).items():
+            if metric in old.get(median, {}):
+                previous = old[median][metric]
+                print(f"{prefix}{metric}: {previous:.3f}s -> {value:.3f}s ({(value - previous) / max(previous, 1e-9):+.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--env", default="SuperMarioBros-1-1-v0")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default="./benchmark_results/startup/")
+    parser.add_argument("--compare", default=None, help="report to compare against")
+    args = parser.parse_args()
+
+    runs = [measure(args.env) for _ in range(args.repeats)]
+    server_runs = [measure(args.env, SERVER_SCRIPT) for _ in range(args.repeats)]
+    report = {
+        "commit": get_commit(),
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "env": args.env,
+        "runs": runs,
+        "median": {
+            metric: float(np.median([run[metric] for run in runs]))
+            for metric in runs[0]
+        },
+        "server_runs": server_runs,
+        "server_median": {
+            metric: float(np.median([run[metric] for run in server_runs]))
+            for metric in server_runs[0]
+        },
+    }
+    print(json.dumps({"environment": report["median"], "server": report["server_median"]}, indent=2))
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, f"{report['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved at {path}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report)
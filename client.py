@@ -1,15 +1,20 @@
 """Module for the client to request and display rendered images."""
+from typing import Union
+import argparse
 import json
 import socket
 import threading
+import time
 import tkinter as tk
+from tkinter import messagebox
 
 import numpy as np
-from PIL import Image
 
 from render import ImageWindow
+from streaming import HEADER, decode_frame
+from tracing import LatencyTracer, estimate_offset
 from utils import Connection
-from utils import create_environment
+from utils import create_environment, state_checksum
 
 
 class Client:
@@ -19,31 +24,63 @@ class Client:
         HOST: The IP address of the server.
         PORT: The port of the server.
         BUFFER_SIZE: The size of the buffer for receiving data.
+        MAX_RESYNCS: Resyncs in a row that may fail the checkpoint before giving up.
 
         s: The socket to communicate with the server.
         root: The main window of the client.
         app: The window to display the rendered images.
         threads: The threads to run the client.
+        tracer: Latency per stage (network, emulate, display, total).
+        clock_offset: Server monotonic clock minus the client one.
+        trace: Trace of the keypress being displayed, in client time.
+        timestep: Actions stepped since the server's last reset (ACTION mode).
+        env_ready: Set once the environment is built (ACTION mode).
+        action_repeat: Frames each action of the server is repeated for (ACTION mode).
+        interval: Seconds between frames on the server (ACTION mode).
+        repeats: Frames left of the current action (ACTION mode).
+        fetch: Seconds between requesting the last frame and having all of it, reported to
+            the server with the next request (FRAME mode).
+        session: Session to join through a session manager, None for a standalone server.
     """
 
     HOST = "10.70.255.242"
     PORT = 16006
     BUFFER_SIZE = 8192
+    MAX_RESYNCS = 3
+
+    def __init__(self, session: Union[None, str] = None):
+        """Initializes the client.
+        The environment is built in the background while the window opens and the
+        client connects, which is most of the startup time.
+
+        Args:
+            session (Union[None, str], optional): session to join through a session manager
+                (see sessions.py). Defaults to None (standalone server).
+        """
+        self.session = session
+        self.connection_type = Connection.ACTION
+        self.env_ready = threading.Event()
+        if self.connection_type == Connection.ACTION:
+            thread = threading.Thread(target=self.build_environment, daemon=True)
+            thread.start()
 
-    def __init__(self):
-        """Initializes the client."""
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.root = tk.Tk()
         self.app = ImageWindow(self.root, "Viewer", on_close=self.close)
         self.buttons = False
-        self.connection_type = Connection.ACTION
-        self.recording_path = "./tmp/agent_play/"
-
-        if self.connection_type == Connection.ACTION:
-            self.env = create_environment("SuperMarioBros-1-1-v0")
-            self.app.update_image(self.env.reset())
+        self.tracer = LatencyTracer("viewer")
+        self.clock_offset = 0.0
+        self.trace = None
+        self.timestep = 0
+        self.action_repeat = 1
+        self.interval = 0.0
+        self.repeats = 0
+        self.last_action = 0
+        self.fetch = None
 
         self.connect()
+        if self.connection_type == Connection.ACTION:
+            self.app.update_image(self.frame)
 
         self.threads = []
         thread = threading.Thread(target=self.display_frame)
@@ -53,9 +90,133 @@ class Client:
         self.root.mainloop()
         self.root.update()
 
+    def build_environment(self) -> None:
+        """Builds the environment (ACTION mode)."""
+        self.env = create_environment("SuperMarioBros-1-1-v0")
+        self.env_ready.set()
+
     def connect(self) -> None:
         """Connects to the server."""
         self.s.connect((self.HOST, self.PORT))
+        if self.session is not None:
+            self.join(self.session)
+        self.sync_clock()
+        if self.connection_type == Connection.ACTION:
+            self.resync()
+
+    def join(self, session: str) -> None:
+        """Asks the session manager to hand the connection over to a session.
+        The connection then talks to the session like to a standalone server.
+
+        Args:
+            session (str): session name
+        """
+        self.s.send(json.dumps({"action": "join", "session": session}).encode())
+        response = self.get_response()
+        if response.get("status") != "joined":
+            self.s.close()
+            raise ConnectionRefusedError(response.get("error", f"Could not join {session}"))
+
+    def resync(self) -> None:
+        """Catches up with the server by fast-forwarding the decisions since its last reset.
+        Used when joining and whenever the emulator diverges from the server. The resync
+        is requested again while the emulator fails the server's checkpoint.
+
+        Raises:
+            RuntimeError: if the emulator still differs after `MAX_RESYNCS` resyncs
+        """
+        for _ in range(self.MAX_RESYNCS):
+            self.s.send(json.dumps({"action": "resync"}).encode())
+            header = self.get_response()
+            self.s.send(b"ok")
+            history = self.recv_exactly(header["length"])
+            timestep, checksum = header["checkpoint"]
+            self.action_repeat = header.get("action_repeat", 1)
+            self.interval = header.get("interval", 0.0)
+            self.repeats = 0
+
+            self.env_ready.wait()
+            frame = self.env.reset()
+            diverged = False
+            for index, action in enumerate([None] + list(history)):
+                if action is not None:
+                    frame = self.step_action(action, frame)
+                if index == timestep and checksum is not None and checksum != state_checksum(self.env):
+                    print(f"Emulator differs from the server at timestep {timestep}, resyncing")
+                    diverged = True
+                    break
+            if not diverged:
+                self.frame = np.array(frame, dtype="uint8")
+                self.timestep = len(history)
+                return
+        raise RuntimeError(f"Emulator still differs from the server after {self.MAX_RESYNCS} resyncs")
+
+    def step_action(self, action: int, frame: np.ndarray) -> np.ndarray:
+        """Steps one decision (the action repeated `action_repeat` times) without drawing.
+
+        Args:
+            action (int): action
+            frame (np.ndarray): current frame, returned if the episode is over
+
+        Returns:
+            np.ndarray: frame after the decision
+        """
+        for _ in range(self.action_repeat):
+            try:
+                frame, *_ = self.env.step(action)
+            except ValueError:
+                break
+        return frame
+
+    def repeat_action(self) -> np.ndarray:
+        """Steps the next repeat of the current action, paced like the server.
+
+        Returns:
+            np.ndarray: The rendered image.
+        """
+        time.sleep(self.interval)
+        self.repeats -= 1
+        try:
+            frame, *_ = self.env.step(self.last_action)
+        except ValueError:
+            self.repeats = 0
+            return self.frame
+        return frame.astype("uint8")
+
+    def recv_exactly(self, length: int) -> bytes:
+        """Receives exactly `length` bytes from the server.
+
+        Args:
+            length (int): amount of bytes
+
+        Returns:
+            bytes: received data
+        """
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.s.recv(min(self.BUFFER_SIZE, length - len(data)))
+            if len(chunk) == 0:
+                raise ConnectionResetError("Server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def sync_clock(self, rounds: int = 5) -> None:
+        """Estimates the offset to the server clock, keeping the round with the lowest RTT.
+
+        Args:
+            rounds (int, optional): amount of round trips. Defaults to 5.
+        """
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.monotonic()
+            self.s.send(json.dumps({"action": "sync"}).encode())
+            response = self.get_response()
+            end = time.monotonic()
+            if response.get("status") == "full":
+                raise ConnectionRefusedError("The server has no room for more viewers")
+            if end - start < best:
+                best = end - start
+                self.clock_offset = estimate_offset(start, response["time"], end)
 
     def close(self, server: bool = False) -> None:
         """Closes the connection and stops the client.
@@ -69,6 +230,8 @@ class Client:
             self.s.send(data.encode())
             self.s.close()
 
+        self.tracer.export()
+
         print("stopping threads")
         for thread in self.threads:
             try:
@@ -84,7 +247,14 @@ class Client:
     def display_frame(self) -> None:
         """Displays the rendered images."""
         while True:
-            self.frame = self.request_frame()
+            try:
+                self.frame = self.request_frame()
+            except RuntimeError as e:
+                # the emulator kept diverging from the server, see resync
+                print(f"Stopping the viewer: {e}")
+                messagebox.showerror("Viewer", f"Lost sync with the server.\n{e}")
+                self.close()
+                break
             try:
                 self.app.update_image(self.frame)
             except RuntimeError:
@@ -93,6 +263,28 @@ class Client:
             except AttributeError:
                 self.close()
                 break
+            self.close_trace()
+
+    def open_trace(self, trace: dict[str, float]) -> None:
+        """Starts tracing a keypress received from the server.
+
+        Args:
+            trace (dict[str, float]): server timestamps of the keypress
+        """
+        received = time.monotonic()
+        pressed = trace["pressed"] - self.clock_offset
+        sent = trace["sent"] - self.clock_offset
+        self.tracer.record("network", received - sent)
+        self.trace = {"pressed": pressed, "received": received}
+
+    def close_trace(self) -> None:
+        """Closes the trace of the keypress once its frame is drawn."""
+        if self.trace is None:
+            return
+        drawn = time.monotonic()
+        self.tracer.record("display", drawn - self.trace.get("stepped", self.trace["received"]))
+        self.tracer.record("total", drawn - self.trace["pressed"])
+        self.trace = None
 
     def display_options(self, label: str) -> None:
         """"""
@@ -106,51 +298,51 @@ class Client:
         Returns:
             list[float]: The rendered image.
         """
-        data = json.dumps({"action": "frame"})
-        self.s.send(data.encode())
+        if self.connection_type == Connection.ACTION and self.repeats > 0:
+            return self.repeat_action()
 
         if self.connection_type == Connection.FRAME:
-            frame = []
-            index = 0
-            length = np.inf
-            h, w, c = 0, 0, 0
-            while index < length:
-                response = self.get_response()
-                if "status" in response.keys():
-                    self.display_options(response.get("human"))
-                    continue
-
-                frame += response.get("frame", [])
-                index = response.get("index", 0)
-                length = response.get("length", 0)
-                data = json.dumps({"index": index, "length": length})
-                self.s.send(data.encode())
-
-            h = response.get("info", {}).get("height", 400)
-            w = response.get("info", {}).get("width", 600)
-            c = response.get("info", {}).get("channels", 3)
-            frame = np.array(frame).reshape((h, w, c))
+            start = time.monotonic()
+            self.s.send(json.dumps({"action": "frame", "fetch": self.fetch}).encode())
+            length, = HEADER.unpack(self.recv_exactly(HEADER.size))
+            response = json.loads(self.recv_exactly(length).decode())
+            if "status" in response.keys():
+                self.display_options(response.get("human"))
+                return self.frame
+
+            if "trace" in response:
+                self.open_trace(response["trace"])
+            payload = self.recv_exactly(response["length"])
+            self.fetch = time.monotonic() - start
+            frame = decode_frame(payload, response["info"])
         else:
+            self.s.send(json.dumps({"action": "frame"}).encode())
             response = self.get_response()
-            if response.get("human"):
-                if "status" in response.keys():
-                    self.display_options(response.get("human"))
-                    return self.frame
-                else:
-                    action = response.get("action")
-                    try:
-                        frame, *_ = self.env.step(action)
-                    except ValueError:
-                        return self.frame
-            else:
-                if "status" in response.keys():
-                    self.display_options(response.get("human"))
-                    return self.frame
-                else:
-                    recording = response.get("recording")
-                    index = response.get("index")
-                    path = f"{self.recording_path}{recording}/{index}.png"
-                    frame = np.array(Image.open(path))
+            if "status" in response.keys():
+                self.display_options(response.get("human"))
+                return self.frame
+
+            action = response.get("action")
+            if "trace" in response:
+                self.open_trace(response["trace"])
+            if response.get("timestep", self.timestep + 1) != self.timestep + 1:
+                print(f"Missed actions at timestep {self.timestep}, resyncing")
+                self.resync()
+                return self.frame
+            if "checksum" in response and response["checksum"] != state_checksum(self.env):
+                print(f"Diverged from the server at timestep {self.timestep}, resyncing")
+                self.resync()
+                return self.frame
+            try:
+                frame, *_ = self.env.step(action)
+            except ValueError:
+                return self.frame
+            self.timestep += 1
+            self.last_action = action
+            self.repeats = self.action_repeat - 1
+            if self.trace is not None:
+                self.trace["stepped"] = time.monotonic()
+                self.tracer.record("emulate", self.trace["stepped"] - self.trace["received"])
         return frame.astype("uint8")
 
     def get_response(self) -> dict[str, any]:
@@ -164,4 +356,8 @@ class Client:
 
 
 if __name__ == "__main__":
-    client = Client()
+    parser = argparse.ArgumentParser(description="Viewer for the AI Festival experience.")
+    parser.add_argument("--session", default=None, help="session to join through sessions.py")
+    args = parser.parse_args()
+
+    client = Client(args.session)
@@ -0,0 +1,107 @@
+"""Module for collapsing near-duplicate frames of the recordings.
+
+Each frame gets a 64-bit difference hash (dHash) of a 9x8 grayscale thumbnail,
+which is cheap to compute and robust to the small changes between consecutive
+frames (e.g. a blinking coin while standing still). Runs of frames of the same
+episode with the same action and a hash within `DUPLICATE_DISTANCE` bits of the
+first frame of the run are collapsed into that frame, and the run length is
+kept as its sample weight, so a weighted sampler sees the same action
+distribution with fewer samples per epoch.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname
+from typing import Union
+
+from PIL import Image
+
+
+HASH_SIZE = 8
+HASH_MASK = (1 << HASH_SIZE * HASH_SIZE) - 1
+DUPLICATE_DISTANCE = 2
+
+
+def frame_hash(path: str) -> int:
+    """Difference hash of a frame.
+
+    Args:
+        path (str): frame file
+
+    Returns:
+        int: 64-bit hash, as a signed integer so it fits in SQLite
+    """
+    image = Image.open(path).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = value << 1 | (left > right)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(a: int, b: int) -> int:
+    """Amount of different bits between two hashes.
+
+    Args:
+        a (int): hash
+        b (int): hash
+
+    Returns:
+        int: hamming distance
+    """
+    return bin((a ^ b) & HASH_MASK).count("1")
+
+
+def hash_frames(paths: list[str], workers: Union[None, int] = None) -> list[int]:
+    """Hash frames in parallel.
+
+    Args:
+        paths (list[str]): frame files
+        workers (Union[None, int], optional): amount of worker processes. Defaults to None (CPUs).
+
+    Returns:
+        list[int]: hash of each frame
+    """
+    if len(paths) == 0:
+        return []
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(frame_hash, paths, chunksize=256))
+
+
+def deduplicate(
+    states: list[str],
+    actions: list[int],
+    hashes: list[int],
+    distance: int = DUPLICATE_DISTANCE
+) -> tuple[list[str], list[int], list[int]]:
+    """Collapse runs of near-duplicate (frame, action) pairs.
+
+    Runs never cross episodes (frames in different folders).
+
+    Args:
+        states (list[str]): frame files, in episode and timestep order
+        actions (list[int]): action of each frame
+        hashes (list[int]): hash of each frame
+        distance (int, optional): maximum hamming distance to the first frame of a run.
+            Defaults to DUPLICATE_DISTANCE.
+
+    Returns:
+        tuple[list[str], list[int], list[int]]: kept frames, their actions and run lengths
+    """
+    kept_states, kept_actions, weights = [], [], []
+    start_hash = None
+    for state, action, value in zip(states, actions, hashes):
+        if (
+            len(kept_states) > 0
+            and kept_actions[-1] == action
+            and dirname(kept_states[-1]) == dirname(state)
+            and hamming(start_hash, value) <= distance
+        ):
+            weights[-1] += 1
+            continue
+        kept_states.append(state)
+        kept_actions.append(action)
+        weights.append(1)
+        start_hash = value
+    return kept_states, kept_actions, weights
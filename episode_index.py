@@ -0,0 +1,282 @@
+"""Module for the SQLite index of the recordings.
+
+The index (`index.db` under the recordings root) holds one row per episode
+(length, success, action histogram, player session, action repeat) and one row per frame
+(action, file and perceptual hash), so training sets can be selected with a query instead of
+scanning the recording folders. It is updated incrementally:
+
+    python episode_index.py --root ./tmp/recordings/
+"""
+from collections import Counter
+from os import listdir
+from typing import Union
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+
+from dedup import frame_hash
+from utils import subsample_step
+from verify import episode_signature
+
+
+SCHEMA_VERSION = 3
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS episodes (
+    episode INTEGER PRIMARY KEY,
+    length INTEGER NOT NULL,
+    success INTEGER,
+    session TEXT,
+    action_repeat INTEGER NOT NULL,
+    histogram TEXT NOT NULL,
+    signature TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    episode INTEGER NOT NULL,
+    timestep INTEGER NOT NULL,
+    action INTEGER NOT NULL,
+    file TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    PRIMARY KEY (episode, timestep)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS episodes_success_length ON episodes (success, length);
+"""
+
+
+class EpisodeIndex:
+    """SQLite index of the recordings.
+
+    Parameters:
+        root_dir (str): root directory for the recordings
+        path (str): SQLite file
+        connection (sqlite3.Connection): connection to the index
+    """
+
+    def __init__(self, root_dir: str, path: str = None):
+        """Episode index.
+
+        Args:
+            root_dir (str): root directory for the recordings
+            path (str, optional): SQLite file. Defaults to "{root_dir}index.db".
+        """
+        self.root_dir = root_dir
+        self.path = f"{root_dir}index.db" if path is None else path
+        self.connection = sqlite3.connect(self.path)
+        version, = self.connection.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self.connection.executescript("DROP TABLE IF EXISTS episodes; DROP TABLE IF EXISTS frames;")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        """Close the connection to the index."""
+        self.connection.close()
+
+    def update(self) -> None:
+        """Index new or changed episodes and drop the deleted ones."""
+        status = {}
+        if os.path.exists(f"{self.root_dir}status.pkl"):
+            with open(f"{self.root_dir}status.pkl", "rb") as f:
+                status = pickle.load(f)
+
+        known = dict(self.connection.execute("SELECT episode, signature FROM episodes"))
+        episodes = [
+            int(folder) for folder in list(next(os.walk(self.root_dir)))[1]
+            if folder.isdigit() and os.path.exists(f"{self.root_dir}{folder}/action.pkl")
+        ]
+        for episode in episodes:
+            signature = repr(episode_signature(f"{self.root_dir}{episode}"))
+            if known.get(episode) != signature:
+                self.add_episode(episode, signature)
+
+        self.connection.executemany(
+            "UPDATE episodes SET success = ? WHERE episode = ?",
+            [(status.get(episode), episode) for episode in episodes]
+        )
+        deleted = [(episode, ) for episode in known if episode not in episodes]
+        self.connection.executemany("DELETE FROM frames WHERE episode = ?", deleted)
+        self.connection.executemany("DELETE FROM episodes WHERE episode = ?", deleted)
+        self.connection.commit()
+
+    def add_episode(self, episode: int, signature: str) -> None:
+        """Index an episode, replacing it if already indexed.
+
+        Args:
+            episode (int): episode number
+            signature (str): signature of the episode folder
+        """
+        folder = f"{self.root_dir}{episode}/"
+        with open(f"{folder}action.pkl", "rb") as f:
+            actions = [int(action) for action in pickle.load(f)]
+        frames = [f for f in listdir(folder) if "png" in f]
+        frames.sort(key=lambda x: int(x.split(".")[0]))
+
+        metadata = {}
+        if os.path.exists(f"{folder}meta.json"):
+            with open(f"{folder}meta.json", "r") as f:
+                metadata = json.load(f)
+
+        histogram = json.dumps(Counter(actions))
+        self.connection.execute("DELETE FROM frames WHERE episode = ?", (episode, ))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO episodes VALUES (?, ?, NULL, ?, ?, ?, ?)",
+            (
+                episode,
+                len(actions),
+                metadata.get("session"),
+                metadata.get("action_repeat", 1),
+                histogram,
+                signature
+            )
+        )
+        frames = frames[:len(actions)]
+        # in-process: the index is updated by the server on close, which must not fork
+        hashes = [frame_hash(f"{folder}{frame}") for frame in frames]
+        self.connection.executemany(
+            "INSERT INTO frames VALUES (?, ?, ?, ?, ?)",
+            [
+                (episode, timestep, action, frame, value)
+                for timestep, (action, frame, value) in enumerate(zip(actions, frames, hashes))
+            ]
+        )
+
+    def where(
+        self,
+        success: Union[None, bool] = None,
+        min_length: int = None,
+        max_length: int = None,
+        session: str = None,
+        episodes: list[int] = None
+    ) -> tuple[str, list[any]]:
+        """Build the WHERE clause for a query over the episodes.
+
+        Args:
+            success (Union[None, bool], optional): only successful (or failed) runs. Defaults to None.
+            min_length (int, optional): minimum episode length. Defaults to None.
+            max_length (int, optional): maximum episode length. Defaults to None.
+            session (str, optional): player session. Defaults to None.
+            episodes (list[int], optional): only these episodes. Defaults to None.
+
+        Returns:
+            tuple[str, list[any]]: clause and its parameters
+        """
+        clauses, parameters = ["1"], []
+        if success is not None:
+            clauses.append("success = ?")
+            parameters.append(int(success))
+        if min_length is not None:
+            clauses.append("length >= ?")
+            parameters.append(min_length)
+        if max_length is not None:
+            clauses.append("length <= ?")
+            parameters.append(max_length)
+        if session is not None:
+            clauses.append("session = ?")
+            parameters.append(session)
+        if episodes is not None:
+            clauses.append(f"episode IN ({', '.join('?' * len(episodes))})")
+            parameters += list(episodes)
+        return " AND ".join(clauses), parameters
+
+    def select(self, **query) -> list[int]:
+        """Select episodes.
+
+        Args:
+            query: filters, see `where`.
+
+        Returns:
+            list[int]: episodes that match the query
+        """
+        clause, parameters = self.where(**query)
+        rows = self.connection.execute(
+            f"SELECT episode FROM episodes WHERE {clause} ORDER BY episode",
+            parameters
+        )
+        return [episode for episode, in rows]
+
+    def lengths(self, **query) -> dict[int, int]:
+        """Length of the matching episodes.
+
+        Args:
+            query: filters, see `where`.
+
+        Returns:
+            dict[int, int]: length of each episode
+        """
+        clause, parameters = self.where(**query)
+        rows = self.connection.execute(
+            f"SELECT episode, length FROM episodes WHERE {clause} ORDER BY episode",
+            parameters
+        )
+        return dict(rows)
+
+    def samples(self, action_repeat: int = 1, **query) -> tuple[list[str], list[int], list[int]]:
+        """Resolve a query to the frame files and actions of the matching episodes.
+
+        Args:
+            action_repeat (int, optional): frames per decision to train on. Episodes recorded
+                with a smaller action repeat are subsampled to match (see `subsample_step`).
+                Defaults to 1.
+            query: filters, see `where`.
+
+        Raises:
+            ValueError: if an episode's action repeat does not divide `action_repeat`
+
+        Returns:
+            tuple[list[str], list[int], list[int]]: frame files, actions and frame hashes, in
+                episode and timestep order
+        """
+        clause, parameters = self.where(**query)
+        steps = {
+            episode: subsample_step(recorded_repeat, action_repeat)
+            for episode, recorded_repeat in self.connection.execute(
+                f"SELECT episode, action_repeat FROM episodes WHERE {clause}",
+                parameters
+            )
+        }
+        rows = self.connection.execute(
+            "SELECT frames.episode, timestep, file, action, hash FROM frames JOIN "
+            f"(SELECT episode FROM episodes WHERE {clause}) AS selected "
+            "ON frames.episode = selected.episode "
+            "ORDER BY frames.episode, timestep",
+            parameters
+        )
+        states, actions, hashes = [], [], []
+        for episode, timestep, file, action, value in rows:
+            if timestep % steps[episode] != 0:
+                continue
+            states.append(f"{self.root_dir}{episode}/{file}")
+            actions.append(action)
+            hashes.append(value)
+        return states, actions, hashes
+
+    def histogram(self, **query) -> dict[int, int]:
+        """Action histogram of the matching episodes.
+
+        Args:
+            query: filters, see `where`.
+
+        Returns:
+            dict[int, int]: amount of each action
+        """
+        clause, parameters = self.where(**query)
+        rows = self.connection.execute(
+            f"SELECT histogram FROM episodes WHERE {clause}",
+            parameters
+        )
+        histogram = Counter()
+        for counts, in rows:
+            histogram.update({int(action): count for action, count in json.loads(counts).items()})
+        return dict(histogram)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the index of the recordings.")
+    parser.add_argument("--root", default="./tmp/recordings/")
+    args = parser.parse_args()
+
+    index = EpisodeIndex(args.root)
+    index.update()
+    print(f"Indexed {len(index.select())} episodes in {index.path}")
+    index.close()
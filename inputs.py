@@ -0,0 +1,108 @@
+"""Module for the player inputs (keyboard and joypad)."""
+from queue import Empty, SimpleQueue
+from typing import NamedTuple
+import threading
+import time
+
+from utils import ACTIONS_MAPPING
+
+
+# "NOOP" is pressed by any unmapped key and, while held, maps every combination to NOOP.
+BUTTONS = {
+    "A": 1 << 0,
+    "B": 1 << 1,
+    "down": 1 << 2,
+    "left": 1 << 3,
+    "right": 1 << 4,
+    "up": 1 << 5,
+    "NOOP": 1 << 6,
+}
+
+
+def build_action_table() -> list[int]:
+    """Build the bitmask to action lookup table from ACTIONS_MAPPING.
+
+    Returns:
+        list[int]: action for each of the possible bitmasks (0 if not mapped)
+    """
+    table = [0] * (1 << len(BUTTONS))
+    for keys, action in ACTIONS_MAPPING.items():
+        if not isinstance(keys, tuple):
+            continue
+        mask = 0
+        for key in keys:
+            mask |= BUTTONS[key]
+        table[mask] = action
+    return table
+
+
+ACTION_TABLE = build_action_table()
+
+
+class InputEvent(NamedTuple):
+    """A key press or release from any input source."""
+    timestamp: float
+    source: str
+    key: str
+    pressed: bool
+
+
+class InputState:
+    """Pressed buttons as a bitmask, shared by the keyboard and joypad listeners.
+
+    Parameters:
+        mask (int): bitmask of the pressed buttons (see BUTTONS)
+        lock (threading.Lock): lock for updating the mask
+        events (SimpleQueue): timestamped stream of InputEvent from all sources
+    """
+
+    def __init__(self):
+        """Input state with no buttons pressed."""
+        self.mask = 0
+        self.lock = threading.Lock()
+        self.events = SimpleQueue()
+
+    def press(self, key: str, source: str = "keyboard") -> None:
+        """Press a button.
+
+        Args:
+            key (str): button name (see BUTTONS)
+            source (str, optional): input source. Defaults to "keyboard".
+        """
+        timestamp = time.monotonic()
+        with self.lock:
+            self.mask |= BUTTONS[key]
+        self.events.put(InputEvent(timestamp, source, key, True))
+
+    def release(self, key: str, source: str = "keyboard") -> None:
+        """Release a button.
+
+        Args:
+            key (str): button name (see BUTTONS)
+            source (str, optional): input source. Defaults to "keyboard".
+        """
+        timestamp = time.monotonic()
+        with self.lock:
+            self.mask &= ~BUTTONS[key]
+        self.events.put(InputEvent(timestamp, source, key, False))
+
+    def action(self) -> int:
+        """Get the action for the pressed buttons.
+
+        Returns:
+            int: Action from ACTIONS_MAPPING dictionary, 0 otherwise
+        """
+        return ACTION_TABLE[self.mask]
+
+    def drain(self) -> list[InputEvent]:
+        """Take all events since the last call.
+
+        Returns:
+            list[InputEvent]: events in the order they happened
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except Empty:
+                return events
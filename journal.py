@@ -0,0 +1,155 @@
+"""Module for the append-only action journal of the recordings.
+
+Each episode folder gets an `actions.journal` with one fixed-width record per
+step (timestep, timestamp, action, flags). Records are appended to memory on
+every tick and written with a single fsync per batch by a background thread,
+so a crash loses at most the last batch instead of the whole episode.
+"""
+from os import listdir
+from typing import Union
+import os
+import pickle
+import struct
+import threading
+import time
+
+
+RECORD = struct.Struct("<IdBB")
+DONE = 1 << 0
+FLAG_GET = 1 << 1
+
+
+class ActionJournal:
+    """Append-only journal of the actions of an episode.
+
+    Parameters:
+        path (str): journal file
+        sync_interval (float): seconds between batched writes
+        pending (list[bytes]): records not yet written
+    """
+
+    def __init__(self, path: str, sync_interval: float = 0.5):
+        """Action journal.
+
+        Args:
+            path (str): journal file
+            sync_interval (float, optional): seconds between batched writes. Defaults to 0.5.
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.file = open(path, "ab")
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, timestep: int, action: int, flags: int = 0) -> None:
+        """Append a record. Terminal records are written right away.
+
+        Args:
+            timestep (int): timestep of the action
+            action (int): action
+            flags (int, optional): DONE and FLAG_GET bits. Defaults to 0.
+        """
+        record = RECORD.pack(timestep, time.time(), action, flags)
+        with self.lock:
+            self.pending.append(record)
+        if flags & DONE:
+            self.wakeup.set()
+
+    def sync(self) -> None:
+        """Write and fsync the pending records."""
+        with self.lock:
+            records, self.pending = self.pending, []
+        if len(records) == 0:
+            return
+        self.file.write(b"".join(records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def run(self) -> None:
+        """Write batches until closed."""
+        while not self.closed:
+            self.wakeup.wait(self.sync_interval)
+            self.wakeup.clear()
+            self.sync()
+
+    def close(self) -> None:
+        """Write the remaining records and close the file."""
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.sync()
+        self.file.close()
+
+
+def read_journal(path: str) -> list[tuple[int, float, int, int]]:
+    """Read a journal, ignoring a torn last record.
+
+    Args:
+        path (str): journal file
+
+    Returns:
+        list[tuple[int, float, int, int]]: (timestep, timestamp, action, flags) records
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    end = len(data) - len(data) % RECORD.size
+    return list(RECORD.iter_unpack(data[:end]))
+
+
+def recover_episode(folder: str) -> Union[None, bool]:
+    """Rebuild `action.pkl` from the journal of an episode.
+
+    Frames without a journaled action (written after the last batch) are removed,
+    so the episode has as many actions as frames.
+
+    Args:
+        folder (str): episode folder
+
+    Returns:
+        Union[None, bool]: True if got to the end, False if died, None if not finished
+    """
+    records = read_journal(os.path.join(folder, "actions.journal"))
+    frames = [f for f in listdir(folder) if "png" in f]
+    length = min(len(records), len(frames))
+
+    for frame in frames:
+        if int(frame.split(".")[0]) >= length:
+            os.remove(os.path.join(folder, frame))
+
+    records = records[:length]
+    with open(os.path.join(folder, "action.pkl"), "wb") as f:
+        pickle.dump([action for _, _, action, _ in records], f)
+
+    for _, _, _, flags in records:
+        if flags & DONE:
+            return bool(flags & FLAG_GET)
+    return None
+
+
+def recover_recordings(root_dir: str, status: dict[int, bool]) -> dict[int, bool]:
+    """Recover the episodes that have a journal but no `action.pkl` (e.g. after a crash).
+
+    Args:
+        root_dir (str): root directory for the recordings
+        status (dict[int, bool]): status of each episode
+
+    Returns:
+        dict[int, bool]: status including the recovered episodes
+    """
+    status = dict(status)
+    for folder in list(next(os.walk(f"{root_dir}")))[1]:
+        path = f"{root_dir}{folder}"
+        if not folder.isdigit():
+            continue
+        if os.path.exists(f"{path}/action.pkl") or not os.path.exists(f"{path}/actions.journal"):
+            continue
+        outcome = recover_episode(path)
+        if outcome is not None:
+            status[int(folder)] = outcome
+        print(f"Recovered: {path} from the action journal")
+    return status
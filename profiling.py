@@ -0,0 +1,223 @@
+"""Module for the opt-in metrics and sampling profiler of the server.
+
+`Metrics` keeps timing histograms and counters per thread and operation (e.g.
+the "step" thread's "emulator_step"), so a stutter can be traced to the thread
+that caused it. `SamplingProfiler` samples the stack of every thread at a fixed
+interval and writes them in the folded format read by flamegraph.pl and
+speedscope:
+
+    flamegraph.pl ./tmp/metrics/profile-<time>.folded > profile.svg
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import ContextManager
+import json
+import os
+import sys
+import threading
+import time
+
+from tracing import LatencyTracer
+
+
+DISABLED = nullcontext()
+
+
+class Metrics:
+    """Timing histograms and counters per thread and operation.
+
+    Disabled metrics cost one attribute check per measurement.
+
+    Parameters:
+        name (str): name used when exporting
+        enabled (bool): whether to collect
+        tracers (dict[str, LatencyTracer]): timings per thread, one stage per operation
+        counters (dict[str, Counter]): counters per thread
+        lock (threading.Lock): guards the tracers and counters shared by the threads
+    """
+
+    def __init__(self, name: str, enabled: bool = False):
+        """Metrics.
+
+        Args:
+            name (str): name used when exporting
+            enabled (bool, optional): whether to collect. Defaults to False.
+        """
+        self.name = name
+        self.enabled = enabled
+        self.tracers = {}
+        self.counters = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def tracer(self, thread: str) -> LatencyTracer:
+        """Get (or create) the timings of a thread.
+
+        Args:
+            thread (str): thread name
+
+        Returns:
+            LatencyTracer: timings of the thread
+        """
+        tracer = self.tracers.get(thread)
+        if tracer is None:
+            with self.lock:
+                tracer = self.tracers.setdefault(thread, LatencyTracer(thread, log_every=None))
+        return tracer
+
+    def measure(self, operation: str) -> ContextManager:
+        """Time a block of the current thread.
+
+        Args:
+            operation (str): operation name
+
+        Returns:
+            ContextManager: context that records the time spent in it
+        """
+        if not self.enabled:
+            return DISABLED
+        return self.timed(operation)
+
+    @contextmanager
+    def timed(self, operation: str):
+        """Record the time spent in the block as `operation` of the current thread."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.tracer(threading.current_thread().name).record(
+                operation,
+                time.perf_counter() - start
+            )
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        """Increment a counter of the current thread.
+
+        Args:
+            counter (str): counter name
+            amount (int, optional): increment. Defaults to 1.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[threading.current_thread().name][counter] += amount
+
+    def summary(self) -> dict[str, dict[str, any]]:
+        """Summarise all threads.
+
+        Returns:
+            dict[str, dict[str, any]]: timings (see `LatencyTracer.summary`) and counters per thread
+        """
+        with self.lock:
+            tracers = dict(self.tracers)
+            counters = {thread: dict(values) for thread, values in self.counters.items()}
+        return {
+            thread: {
+                "timings": tracers[thread].summary() if thread in tracers else {},
+                "counters": counters.get(thread, {}),
+            }
+            for thread in sorted(set(tracers) | set(counters))
+        }
+
+    def dump(self, path: str = "./tmp/metrics/") -> str:
+        """Print the summary and export it as JSON.
+
+        Args:
+            path (str, optional): folder for the report. Defaults to "./tmp/metrics/".
+
+        Returns:
+            str: report file
+        """
+        summary = self.summary()
+        for thread, values in summary.items():
+            for operation, timing in values["timings"].items():
+                print(
+                    f"[{self.name}:{thread}] {operation}: n={timing['count']} "
+                    f"p50={timing['p50_ms']:.2f}ms p99={timing['p99_ms']:.2f}ms "
+                    f"max={timing['max_ms']:.2f}ms"
+                )
+            for counter, value in values["counters"].items():
+                print(f"[{self.name}:{thread}] {counter}: {value}")
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        report = os.path.join(path, f"{self.name}-{timestamp}.json")
+        with open(report, "w") as f:
+            json.dump(summary, f, indent=2)
+        return report
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads in the background.
+
+    Parameters:
+        interval (float): seconds between samples
+        stacks (Counter): samples per folded stack ("thread;outer;...;inner")
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """Sampling profiler.
+
+        Args:
+            interval (float, optional): seconds between samples. Defaults to 0.005.
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        """Start sampling."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self) -> None:
+        """Sample until stopped."""
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                samples.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(samples)
+
+    def write(self, path: str = "./tmp/metrics/") -> str:
+        """Write the samples so far in the folded stack format.
+
+        Args:
+            path (str, optional): folder for the profile. Defaults to "./tmp/metrics/".
+
+        Returns:
+            str: profile file
+        """
+        with self.lock:
+            stacks = dict(self.stacks)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        profile = os.path.join(path, f"profile-{timestamp}.folded")
+        with open(profile, "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return profile
@@ -0,0 +1,100 @@
+"""Module for reading agent replays.
+
+A replay is the action sequence of an agent episode (`action.pkl`, and the
+action repeat it was recorded with in `meta.json`), played back from a reset
+through the server's emulator like a human player.
+"""
+from os import listdir
+from typing import NamedTuple, Union
+import json
+import os
+import pickle
+import random
+
+
+class ReplayEntry(NamedTuple):
+    """A replay in the catalog.
+
+    Parameters:
+        episode (str): folder name of the replay
+        length (int): amount of decisions
+        outcome (Union[None, bool]): True if got to the end, False if died, None if unknown
+        actions (list[int]): action of each decision
+        action_repeat (int): frames each action was repeated for when recorded
+    """
+    episode: str
+    length: int
+    outcome: Union[None, bool]
+    actions: list[int]
+    action_repeat: int
+
+
+def resample_actions(actions: list[int], recorded_repeat: int, action_repeat: int) -> list[int]:
+    """Convert the decisions of a replay to the server's action repeat.
+
+    Args:
+        actions (list[int]): action of each decision, as recorded
+        recorded_repeat (int): frames each action was repeated for when recorded
+        action_repeat (int): frames each action is repeated for by the server
+
+    Returns:
+        list[int]: action of each decision of the server
+    """
+    if recorded_repeat == action_repeat:
+        return list(actions)
+    frames = [action for action in actions for _ in range(recorded_repeat)]
+    return frames[::action_repeat]
+
+
+class ReplayCatalog:
+    """Catalog of the agent replays, built once when the server starts.
+
+    Parameters:
+        path (str): folder with the replays (one folder per episode).
+        entries (dict[str, ReplayEntry]): replays by episode.
+    """
+
+    def __init__(self, path: str):
+        """Replay catalog.
+
+        Args:
+            path (str): folder with the replays.
+        """
+        self.path = path
+        self.entries = {}
+        if not os.path.exists(path):
+            return
+
+        status = {}
+        if os.path.exists(f"{path}status.pkl"):
+            with open(f"{path}status.pkl", "rb") as f:
+                status = pickle.load(f)
+
+        for folder in listdir(path):
+            if ".ipynb_checkpoints" in folder or not os.path.isdir(os.path.join(path, folder)):
+                continue
+            if not os.path.exists(os.path.join(path, folder, "action.pkl")):
+                print(f"Skipping replay {folder}: no action found")
+                continue
+            with open(os.path.join(path, folder, "action.pkl"), "rb") as f:
+                actions = [int(action) for action in pickle.load(f)]
+            action_repeat = 1
+            if os.path.exists(os.path.join(path, folder, "meta.json")):
+                with open(os.path.join(path, folder, "meta.json"), "r") as f:
+                    action_repeat = json.load(f).get("action_repeat", 1)
+            outcome = status.get(int(folder)) if folder.isdigit() else None
+            self.entries[folder] = ReplayEntry(folder, len(actions), outcome, actions, action_repeat)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, episode: str) -> ReplayEntry:
+        return self.entries[episode]
+
+    def choice(self) -> ReplayEntry:
+        """Pick a random replay.
+
+        Returns:
+            ReplayEntry: replay
+        """
+        return random.choice(list(self.entries.values()))
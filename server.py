@@ -1,26 +1,61 @@
 """Server module for the AI Festival experience."""
-from queue import Queue
-from typing import Union
+from datetime import datetime
+from multiprocessing.connection import Connection as Pipe
+from multiprocessing.reduction import recv_handle
+from queue import Empty, Queue
+from typing import TYPE_CHECKING, Union
 import json
 import os
 from os import listdir
 import pickle
 import random
+import signal
 import socket
-import shutil
 import threading
 import time
 import tkinter as tk
 
-from pynput import keyboard
-from pynput.keyboard import Key
 from PIL import Image
 import numpy as np
-import pygame
 
+from episode_index import EpisodeIndex
+from inputs import InputState
+from journal import DONE, FLAG_GET, ActionJournal, recover_recordings
+from profiling import Metrics, SamplingProfiler
 from render import ImageWindow
-from utils import ACTIONS_MAPPING, Connection
-from utils import create_environment
+from replay import ReplayCatalog, resample_actions
+from streaming import FrameStreamer, pack_message
+from tracing import LatencyTracer
+from utils import Connection
+from utils import create_environment, state_checksum
+from verify import verify_recordings
+
+if TYPE_CHECKING:
+    from pynput.keyboard import Key
+
+
+class Viewer:
+    """A viewer connected to the server.
+
+    Parameters:
+        conn (socket.socket): connection to the viewer
+        addr (tuple[str, int]): address of the viewer
+        stream (FrameStreamer): quality of the frames sent to the viewer (FRAME mode)
+        action_queue (Queue): decisions not yet sent to the viewer (ACTION mode)
+    """
+
+    def __init__(self, conn: socket.socket, addr: tuple[str, int], interval: float):
+        """Viewer.
+
+        Args:
+            conn (socket.socket): connection to the viewer
+            addr (tuple[str, int]): address of the viewer
+            interval (float): seconds between frames on the server
+        """
+        self.conn = conn
+        self.addr = addr
+        self.stream = FrameStreamer(interval)
+        self.action_queue = Queue()
 
 
 class Server:
@@ -30,255 +65,545 @@ class Server:
         HOST: The IP address of the server.
         PORT: The port of the server.
         BUFFER_SIZE: The size of the buffer for receiving data.
+        JOYPAD_TIMEOUT: Milliseconds to wait for a joypad event before checking for closing.
+        CHECKPOINT_INTERVAL: Decisions between emulator checksums sent to the viewer (ACTION mode).
+        HANDOFF_TIMEOUT: Seconds to wait for a handed over viewer before checking for closing.
 
         s (socket.socket): socket connection
         done (bool): whether the game is done
-        human (bool): whether the player is human
-        pressed_keys (list): list of pressed keys - used for actions
+        human (bool): whether the player is human, otherwise an agent replay is played
+        player (str): "human", "agent" or "random", decided when the first viewer joins
+        inputs (InputState): pressed buttons (bitmask) and input events - used for actions
+        tracer (LatencyTracer): latency per stage (input and queue)
+        frame_trace (dict): trace of the last stepped keypress (FRAME mode)
         closing (bool): whether the server is closing
         record (bool): whether to record the experience
         episode (int): episode number (look at root_dir and increments by 1)
         timestep (int): timestep number
         actions (list): list of actions
+        journal (ActionJournal): append-only journal of the actions of the episode
         status (dict): status of the episode (True if got to the end, False if died)
         root_dir (str): root directory for the recordings
-        environment (gym.Env): gym environment
-        root (tk.Tk): tkinter root
+        session (str): server start time, the player session is "{session}-{connections}"
+        connections (int): amount of viewers connected so far
+        viewers (list[Viewer]): viewers connected
+        max_viewers (int): viewers allowed at the same time, the others are refused
+        handoff (Pipe): pipe the viewers' sockets are handed over through by a session
+            manager, None when listening on HOST and PORT
+        joystick (int): index of the joypad of the player, None for no joypad
+        environment (gym.Env): gym environment, built in the background
+        env_ready (threading.Event): set once the environment is built and reset
+        root (tk.Tk): tkinter root, None without a window
         app (ImageWindow): image window
-        threads (list): list of threads (connect, render_frame, step)
-        listener (keyboard.Listener): keyboard listener
-        frame (np.ndarray): frame of the environment
+        threads (list): list of threads (build_environment, connect, render_frame, step,
+            listen_joypad)
+        listener (keyboard.Listener): keyboard listener, None without keyboard input
+        frame (np.ndarray): frame of the environment, black until it is built
+        frames (int): frames stepped so far, numbers the frames sent to the viewers (FRAME mode)
+        replay_catalog (ReplayCatalog): agent replays available
+        agent_replay (ReplayEntry): replay being played
+        agent_actions (list[int]): decisions of the replay at the server's action repeat
+        agent_index (int): next decision of the replay, restarts with the environment
+        action_repeat (int): frames each action is repeated for (one decision)
+        history (bytearray): decisions since the last environment reset (ACTION mode)
+        checkpoint (tuple[int, int]): decision and emulator checksum of the last checkpoint
+        resets (int): amount of environment resets, ends a decision interrupted by a reset
+        state_lock (threading.Lock): keeps the environment, history, viewers and their action
+            queues consistent
+        metrics (Metrics): timings and counters per thread and operation (opt-in)
+        profiler (SamplingProfiler): stack sampler for flame graphs, None if disabled
     """
 
     HOST = "10.70.255.242"
     PORT = 16006
     BUFFER_SIZE = 1024
-
-    def __init__(self, env_name: str = "SuperMarioBros-1-1-v0", record: bool = False):
+    JOYPAD_TIMEOUT = 100
+    CHECKPOINT_INTERVAL = 60
+    HANDOFF_TIMEOUT = 0.1
+
+    def __init__(
+        self,
+        env_name: str = "SuperMarioBros-1-1-v0",
+        record: bool = False,
+        action_repeat: int = 1,
+        metrics: bool = False,
+        profile: bool = False,
+        host: str = None,
+        port: int = None,
+        player: str = "random",
+        joystick: Union[None, int] = 0,
+        keyboard_input: bool = True,
+        window: bool = True,
+        max_viewers: int = 1,
+        root_dir: str = "./tmp/recordings/",
+        handoff: Union[None, Pipe] = None
+    ):
         """Server class for the AI Festival experience.
+        With metrics or profiling on, "m" or SIGUSR1 dumps them to "./tmp/metrics/".
+        Without a window, the server runs until SIGTERM, or until its connect or step
+        thread dies, in which case it exits with status 1.
 
         Args:
             env_name (str, optional): gym environment name. Defaults to "SuperMarioBros-1-1-v0".
             record (bool, optional): whether to record the experience. Defaults to False.
+            action_repeat (int, optional): frames each action is repeated for. Defaults to 1.
+            metrics (bool, optional): whether to time the operations of each thread.
+                Defaults to False.
+            profile (bool, optional): whether to sample the stacks of all threads.
+                Defaults to False.
+            host (str, optional): address to listen on. Defaults to HOST.
+            port (int, optional): port to listen on. Defaults to PORT.
+            player (str, optional): "human", "agent" or "random". Defaults to "random".
+            joystick (Union[None, int], optional): index of the player's joypad, None for no
+                joypad. Defaults to 0.
+            keyboard_input (bool, optional): whether the player uses this machine's keyboard.
+                Defaults to True.
+            window (bool, optional): whether to show the player window. Defaults to True.
+            max_viewers (int, optional): viewers allowed at the same time. Defaults to 1.
+            root_dir (str, optional): root directory for the recordings.
+                Defaults to "./tmp/recordings/".
+            handoff (Union[None, Pipe], optional): pipe the viewers' sockets are handed over
+                through by a session manager, instead of listening on host and port.
+                Defaults to None.
         """
+        if host is not None:
+            self.HOST = host
+        if port is not None:
+            self.PORT = port
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.handoff = handoff
+        self.metrics = Metrics("server", enabled=metrics)
+        self.profiler = None
+        if profile:
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+        if (metrics or profile) and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_metrics())
 
         self.done = False
         self.human = True
-        self.pressed_keys = []
+        self.inputs = InputState()
+        self.frame_trace = None
+        self.tracer = LatencyTracer("server")
         self.closing = False
         self.connection_type = Connection.ACTION
-        if self.connection_type == Connection.ACTION:
-            self.action_queue = Queue()
+        self.action_repeat = action_repeat
+        self.history = bytearray()
+        self.checkpoint = (0, None)
+        self.resets = 0
+        self.frames = 0
+        self.state_lock = threading.Lock()
 
         self.record = record
         self.episode = 0
         self.timestep = 0
         self.actions = []
+        self.journal = None
         self.status = {}
-        self.root_dir = "./tmp/recordings/"
+        self.root_dir = root_dir
+        self.session = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.connections = 0
+        self.viewers = []
+        self.max_viewers = max_viewers
+        self.player = player
+        self.joystick = joystick
         self.timeout = 1/40
         if self.record:
             self.start_recording()
 
+        self.replay_catalog = ReplayCatalog("./tmp/agent_play/")
+        self.agent_replay = None
+        self.agent_actions = []
+        self.agent_index = 0
+
+        # the emulator is most of the startup, so the window and socket open meanwhile
+        self.environment = None
+        self.env_ready = threading.Event()
+        self.frame = np.zeros((240, 256, 3), dtype=np.uint8)
+        builder = threading.Thread(
+            target=self.build_environment,
+            args=(env_name, ),
+            name="build_environment"
+        )
+        builder.start()
+
+        self.root = None
+        if window:
+            self.root = tk.Tk()
+            self.app = ImageWindow(self.root, "Player")
+
+        self.open_socket()
+
+        targets = [self.connect, self.step]
+        if window:
+            targets.append(self.render_frame)
+        if joystick is not None:
+            targets.append(self.listen_joypad)
+        self.threads = [builder]
+        for target in targets:
+            thread = threading.Thread(target=target, name=target.__name__)
+            thread.start()
+            self.threads.append(thread)
+
+        self.listener = None
+        if keyboard_input:
+            self.listen_keyboard()
+
+        if window:
+            self.root.mainloop()
+            self.root.update()
+            exit()
+        else:
+            signal.signal(signal.SIGTERM, self.on_terminate)
+            crashed = False
+            while not self.closing and not crashed:
+                time.sleep(0.5)
+                # the threads also stop once closing, that is not a crash
+                crashed = not self.closing and (
+                    not all(
+                        thread.is_alive() for thread in self.threads
+                        if thread.name in ("connect", "step")
+                    ) or not (builder.is_alive() or self.env_ready.is_set())
+                )
+            if crashed:
+                print("A server thread stopped unexpectedly, closing")
+            self.closing = True
+            self.close()
+            exit(1 if crashed else 0)
+
+    def build_environment(self, env_name: str) -> None:
+        """Build and reset the environment, then let the players and viewers in.
+
+        Args:
+            env_name (str): gym environment name
+        """
         self.environment = create_environment(env_name)
         self.reset()
+        self.env_ready.set()
 
-        self.root = tk.Tk()
-        self.app = ImageWindow(self.root, "Player")
+    def wait_environment(self) -> bool:
+        """Wait until the environment is built.
 
-        self.open_socket()
+        Returns:
+            bool: True once built, False if the server closed before
+        """
+        while not self.env_ready.wait(self.timeout):
+            if self.closing:
+                return False
+        return True
+
+    def on_terminate(self, signum: int, frame: any) -> None:
+        """Close when terminated (without a window)."""
+        self.closing = True
 
-        self.threads = []
-        thread = threading.Thread(target=self.connect)
-        thread.start()
-        self.threads.append(thread)
-
-        thread = threading.Thread(target=self.render_frame)
-        thread.start()
-        self.threads.append(thread)
-
-        thread = threading.Thread(target=self.step)
-        thread.start()
-        self.threads.append(thread)
-
-        thread = threading.Thread(target=self.listen_joypad)
-        thread.start()
-        self.threads.append(thread)
-
-        self.listen_keyboard()
-
-        self.root.mainloop()
-        self.root.update()
-        exit()
-
-    def load_replay(self) -> list[list[float]]:
-        path = "./tmp/agent_play/"
-        folders = [
-            os.path.join(path, f)
-            for f in listdir(path)
-            if ".ipynb_checkpoints" not in f
-        ]
-        folder = random.choice(folders)
-        images = [
-            os.path.join(folder, f)
-            for f in listdir(folder)
-            if "png" in f
-        ]
-        images.sort(key=lambda x: int(x.split("/")[-1].split(".")[0]))
-        return images, folder.split("/")[-1]
+    def assign_player(self) -> None:
+        """Decide whether a human or an agent replay plays the next game."""
+        self.human = True
+        if (
+            (self.player == "agent" or (self.player == "random" and random.random() > 0.5))
+            and len(self.replay_catalog) > 0
+        ):
+            print("agent")
+            self.load_replay()
+            self.human = False
+        else:
+            print("human")
+
+    def load_replay(self) -> None:
+        """Pick an agent replay and convert its decisions to the server's action repeat.
+        The actions are played from the next reset, so viewers get them like a human's."""
+        self.agent_replay = self.replay_catalog.choice()
+        self.agent_actions = resample_actions(
+            self.agent_replay.actions,
+            self.agent_replay.action_repeat,
+            self.action_repeat
+        )
+        print(f"Playing replay {self.agent_replay.episode}")
+
+    def agent_finished(self) -> bool:
+        """Whether the agent replay ran out of actions.
+
+        Returns:
+            bool: True if an agent is playing and has no actions left
+        """
+        return not self.human and self.agent_index >= len(self.agent_actions)
 
     ##################### SOCKET RELATED #####################
     def open_socket(self) -> None:
-        """Open socket connection."""
+        """Open socket connection. Behind a session manager the viewers are handed over instead."""
+        if self.handoff is not None:
+            return
         print(f"Connection opened on {self.HOST} at {self.PORT}")
         self.s.bind((self.HOST, self.PORT))
         self.s.listen()
 
     def connect(self) -> None:
-        """Connect to the client."""
-        self.conn, self.addr = self.s.accept()
+        """Accept viewers, up to `max_viewers` at a time, each served by its own thread."""
+        while not self.closing:
+            try:
+                conn, addr = self.accept()
+            except OSError:
+                break
+            if conn is None:
+                continue
 
-        self.human = True
-        if random.random() > 1:
-            print("agent")
-            self.human = False
-            self.agent_replay_count = 0
-            self.agent_replay, self.folder = self.load_replay()
-        else:
-            print("human")
+            with self.state_lock:
+                full = len(self.viewers) >= self.max_viewers
+            if full:
+                print(f"Refusing {addr}: {self.max_viewers} viewers already connected")
+                conn.send(json.dumps({"status": "full"}).encode())
+                conn.close()
+                continue
 
-        print(f"Connected by {self.addr}")
-        self.reset()
-        while not self.closing:
-            data = self.conn.recv(self.BUFFER_SIZE)
-            data = json.loads(data.decode())
-            match data.get("action", ""):
-                case "frame":
-                    if self.human:
+            self.connections += 1
+            thread = threading.Thread(
+                target=self.serve,
+                args=(conn, addr),
+                name=f"viewer-{self.connections}",
+                daemon=True
+            )
+            thread.start()
+
+    def accept(self) -> tuple[Union[None, socket.socket], Union[None, tuple[str, int]]]:
+        """Accept the next viewer, or take the next one handed over by the session manager.
+
+        Returns:
+            tuple[Union[None, socket.socket], Union[None, tuple[str, int]]]: connection and
+                address of the viewer, None if no viewer was handed over within a tick
+        """
+        if self.handoff is None:
+            return self.s.accept()
+        if not self.handoff.poll(self.HANDOFF_TIMEOUT):
+            return None, None
+        conn = socket.socket(fileno=recv_handle(self.handoff))
+        return conn, conn.getpeername()
+
+    def serve(self, conn: socket.socket, addr: tuple[str, int]) -> None:
+        """Serve a viewer until it closes the connection.
+        The first viewer of an idle server starts a new game; the others join it.
+
+        Args:
+            conn (socket.socket): connection to the viewer
+            addr (tuple[str, int]): address of the viewer
+        """
+        viewer = Viewer(conn, addr, self.timeout)
+        with self.state_lock:
+            first = len(self.viewers) == 0
+            self.viewers.append(viewer)
+        print(f"Connected by {addr}")
+
+        try:
+            if not self.wait_environment():
+                return
+            if first:
+                self.assign_player()
+                self.reset()
+            while not self.closing:
+                data = conn.recv(self.BUFFER_SIZE)
+                data = json.loads(data.decode())
+                match data.get("action", ""):
+                    case "frame":
                         if self.connection_type == Connection.FRAME:
+                            viewer.stream.update(data.get("fetch"))
                             if self.done:
-                                data = {"status": "finish", "human": True}
-                                self.conn.send(json.dumps(data).encode())
+                                data = {"status": "finish", "human": self.human}
+                                conn.sendall(pack_message(data))
                             else:
-                                self.send_frame()
+                                self.send_frame(viewer)
                         else:
-                            if self.done and self.action_queue.empty():
-                                data = {"status": "finish", "human": True}
-                                self.conn.send(json.dumps(data).encode())
-                            else:
-                                action = self.action_queue.get()
-                                data = {"human": True, "action": action}
-                                self.conn.send(json.dumps(data).encode())
-                    else:
-                        if self.agent_replay_count == len(self.agent_replay) - 1:
-                            data = {"status": "finish", "human": self.human}
-                            self.conn.send(json.dumps(data).encode())
-                        else:
-                            if self.connection_type == Connection.FRAME:
-                                self.send_replay()
-                            else:
-                                time.sleep(self.timeout)
-                                data = {
-                                    "human": False,
-                                    "recording": self.folder,
-                                    "index": self.agent_replay_count
-                                }
-                                self.conn.send(json.dumps(data).encode())
-                                self.agent_replay_count += 1
-
-                case "close":
-                    print(f"Closing connection with {self.addr}")
-                    self.conn.send(b"ok")
-                    self.conn.close()
-                    break
-                case _:
-                    self.conn.send(b"{}")
-        self.connect()
+                            data = self.next_decision(viewer)
+                            if data is None:
+                                data = {"status": "finish", "human": self.human}
+                            trace = data.get("trace")
+                            if trace is not None:
+                                trace["sent"] = time.monotonic()
+                                self.tracer.record("queue", trace["sent"] - trace["stepped"])
+                            with self.metrics.measure("json_encode"):
+                                data = json.dumps(data).encode()
+                            with self.metrics.measure("socket_send"):
+                                conn.send(data)
+
+                    case "sync":
+                        data = {"time": time.monotonic()}
+                        conn.send(json.dumps(data).encode())
+                    case "resync":
+                        self.send_history(viewer)
+                    case "close":
+                        print(f"Closing connection with {addr}")
+                        conn.send(b"ok")
+                        conn.close()
+                        break
+                    case _:
+                        conn.send(b"{}")
+        except (OSError, json.JSONDecodeError):
+            print(f"Lost connection with {addr}")
+            conn.close()
+        finally:
+            with self.state_lock:
+                self.viewers.remove(viewer)
+
+    def next_decision(self, viewer: Viewer) -> Union[None, dict[str, any]]:
+        """Wait for the next decision of the viewer (ACTION mode).
+
+        Args:
+            viewer (Viewer): viewer
+
+        Returns:
+            Union[None, dict[str, any]]: decision, None if the game is over
+        """
+        while not self.closing:
+            if self.done and viewer.action_queue.empty():
+                return None
+            try:
+                # the queue is replaced on reset and resync, so do not wait on it for long
+                return viewer.action_queue.get(timeout=self.timeout)
+            except Empty:
+                continue
+        return None
 
     def close(self) -> None:
-        """Verifies data, closes all connections, and terminate all threads."""
-        self.verify_data()
+        """Verifies data (when recording), closes all connections, and terminate all threads."""
+        if self.journal is not None:
+            self.journal.close()
+        if self.record:
+            self.verify_data()
+        self.tracer.export()
+        if self.metrics.enabled or self.profiler is not None:
+            self.dump_metrics()
         for thread in self.threads:
             thread.join(0)
-        self.root.destroy()
-        self.root.quit()
+        if self.root is not None:
+            self.root.destroy()
+            self.root.quit()
+        try:
+            self.s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.s.close()
-        self.listener.stop()
-        exit()
-
-    def send_frame(self) -> None:
-        """Send frame to the client."""
-        h, w, c = self.frame.shape
-        render = self.frame.reshape((-1))
-        indexes = list(range(0, render.shape[0], 1024))
-        indexes += [render.shape[0]]
-        for i, index in enumerate(indexes[:-1]):
-            data = {
-                "info": {
-                    "height": h,
-                    "width": w,
-                    "channels": c
-                },
-                "frame": render[index:indexes[i+1]].tolist(),
-                "index": i,
-                "length": len(indexes) - 2,
-            }
-            data = json.dumps(data)
-            self.conn.send(data.encode())
-            self.conn.recv(self.BUFFER_SIZE)
-
-    def send_replay(self) -> None:
-        """Send replay to the client."""
-        frame = self.agent_replay[self.agent_replay_count]
-        frame = Image.open(frame)
-        frame = np.array(frame)
-        h, w, c = frame.shape
-        render = frame.reshape((-1))
-        indexes = list(range(0, render.shape[0], 1024))
-        indexes += [render.shape[0]]
-        for i, index in enumerate(indexes[:-1]):
-            data = {
-                "info": {
-                    "height": h,
-                    "width": w,
-                    "channels": c
-                },
-                "frame": render[index:indexes[i+1]].tolist(),
-                "index": i,
-                "length": len(indexes) - 2,
-            }
-            data = json.dumps(data)
-            self.conn.send(data.encode())
-            self.conn.recv(self.BUFFER_SIZE)
-        if self.agent_replay_count + 1 < len(self.agent_replay):
-            self.agent_replay_count += 1
+        if self.listener is not None:
+            self.listener.stop()
+
+    def dump_metrics(self) -> None:
+        """Print and export the metrics of each thread and, if profiling, the sampled stacks."""
+        if self.metrics.enabled:
+            print(f"Metrics saved at {self.metrics.dump()}")
+        if self.profiler is not None:
+            print(f"Profile saved at {self.profiler.write()}")
+
+    def send_frame(self, viewer: Viewer) -> None:
+        """Send the newest frame to the viewer.
+        Waits up to one tick for a frame the viewer has not seen yet; the frames stepped
+        while the viewer was busy are skipped. The trace of the last stepped keypress
+        (if any) goes with the frame.
+
+        Args:
+            viewer (Viewer): viewer
+        """
+        requested = time.monotonic()
+        deadline = requested + self.timeout
+        while viewer.stream.is_stale(self.frames) and time.monotonic() < deadline:
+            time.sleep(self.timeout / 4)
+
+        frame_number, frame = self.frames, self.frame
+        trace, self.frame_trace = self.frame_trace, None
+        self.stream_frame(viewer, frame, frame_number, requested, trace)
+
+    def stream_frame(
+        self,
+        viewer: Viewer,
+        frame: np.ndarray,
+        frame_number: int,
+        requested: float,
+        trace: Union[None, dict[str, float]] = None
+    ) -> None:
+        """Send a frame as one message, its header followed by the compressed pixels
+        (FRAME mode). The time spent serving it is kept to adapt the quality when the
+        viewer reports its wait.
+
+        Args:
+            viewer (Viewer): viewer
+            frame (np.ndarray): frame
+            frame_number (int): number of the frame, to count the skipped ones
+            requested (float): monotonic time the viewer's request was received
+            trace (Union[None, dict[str, float]], optional): trace of the keypress. Defaults to None.
+        """
+        skipped = viewer.stream.skipped
+        with self.metrics.measure("frame_encode"):
+            payload, info = viewer.stream.encode(frame, frame_number)
+        self.metrics.count("frames_skipped", viewer.stream.skipped - skipped)
+        data = {"info": info, "length": len(payload)}
+        if trace is not None:
+            trace["sent"] = time.monotonic()
+            self.tracer.record("queue", trace["sent"] - trace["stepped"])
+            data["trace"] = trace
+
+        with self.metrics.measure("json_encode"):
+            message = pack_message(data, payload)
+        with self.metrics.measure("socket_send"):
+            viewer.conn.sendall(message)
+        self.metrics.count("bytes_sent", len(message))
+        viewer.stream.sent(time.monotonic() - requested)
+
+    def send_history(self, viewer: Viewer) -> None:
+        """Send the decisions since the last reset, so the viewer can catch up (ACTION mode).
+        The viewer fast-forwards its own emulator and checks the last checkpoint; the
+        decisions made afterwards follow through its (new) action queue.
+
+        Args:
+            viewer (Viewer): viewer
+        """
+        with self.state_lock:
+            history = bytes(self.history)
+            checkpoint = self.checkpoint
+            viewer.action_queue = Queue()
+
+        data = {
+            "resync": True,
+            "length": len(history),
+            "checkpoint": checkpoint,
+            "action_repeat": self.action_repeat,
+            "interval": self.timeout,
+        }
+        viewer.conn.send(json.dumps(data).encode())
+        viewer.conn.recv(self.BUFFER_SIZE)
+        viewer.conn.sendall(history)
 
     ##################### INPUT RELATED #####################
     def listen_keyboard(self) -> None:
         """Listen to keyboard inputs."""
+        from pynput import keyboard
+
         self.listener = keyboard.Listener(
             on_press=self.on_press,
             on_release=self.on_release
         )
+        self.listener.name = "keyboard"
         self.listener.start()
 
     def listen_joypad(self) -> None:
-        """Listen to joypad inputs."""
+        """Listen to joypad inputs. Blocks on the event queue instead of polling it."""
         print("Start listening to joypad")
+        import pygame
 
         pygame.init()
-        if pygame.joystick.get_count() == 0:
+        if pygame.joystick.get_count() <= self.joystick:
             return
 
-        self.joystick = pygame.joystick.Joystick(0)
-        self.joystick.init()
+        self.joypad = pygame.joystick.Joystick(self.joystick)
+        self.joypad.init()
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([
+            pygame.JOYBUTTONDOWN,
+            pygame.JOYBUTTONUP,
+            pygame.JOYAXISMOTION
+        ])
 
         self.last_horizontal = None
         self.last_vertical = None
 
         while not self.closing:
-            for event in pygame.event.get():
+            event = pygame.event.wait(self.JOYPAD_TIMEOUT)
+            for event in [event] + pygame.event.get():
                 if event.type == pygame.JOYBUTTONDOWN:
                     self.on_joy_press(event.button)
                 if event.type == pygame.JOYBUTTONUP:
@@ -312,38 +637,38 @@ class Server:
     def on_joy_press(self, key: str) -> None:
         match key:
             case 1:
-                self.add_pressed_keys("A")
+                self.add_pressed_keys("A", "joypad")
             case 0:
-                self.add_pressed_keys("B")
+                self.add_pressed_keys("B", "joypad")
             case "right":
-                self.add_pressed_keys("right")
+                self.add_pressed_keys("right", "joypad")
             case "left":
-                self.add_pressed_keys("left")
+                self.add_pressed_keys("left", "joypad")
             case "up":
-                self.add_pressed_keys("up")
+                self.add_pressed_keys("up", "joypad")
             case "down":
-                self.add_pressed_keys("down")
+                self.add_pressed_keys("down", "joypad")
             case _:
-                self.add_pressed_keys("NOOP")
+                self.add_pressed_keys("NOOP", "joypad")
 
     def on_joy_release(self, key: str) -> None:
         match key:
             case 1:
-                self.remove_pressed_keys("A")
+                self.remove_pressed_keys("A", "joypad")
             case 0:
-                self.remove_pressed_keys("B")
+                self.remove_pressed_keys("B", "joypad")
             case "right":
-                self.remove_pressed_keys("right")
+                self.remove_pressed_keys("right", "joypad")
             case "left":
-                self.remove_pressed_keys("left")
+                self.remove_pressed_keys("left", "joypad")
             case "up":
-                self.remove_pressed_keys("up")
+                self.remove_pressed_keys("up", "joypad")
             case "down":
-                self.remove_pressed_keys("down")
+                self.remove_pressed_keys("down", "joypad")
             case _:
-                self.remove_pressed_keys("NOOP")
+                self.remove_pressed_keys("NOOP", "joypad")
 
-    def get_key(self, key: Key) -> str:
+    def get_key(self, key: "Key") -> str:
         """Get key from the event.
 
         Args:
@@ -364,6 +689,8 @@ class Server:
         Args:
             key (str): key string
         """
+        from pynput import keyboard
+
         match self.get_key(key):
             case keyboard.Key.up:
                 self.add_pressed_keys("up")
@@ -377,8 +704,10 @@ class Server:
                 self.add_pressed_keys("A")
             case "x":
                 self.add_pressed_keys("B")
-            case "r":
-                self.frame = self.environment.reset()
+            case "r" if self.env_ready.is_set():
+                self.reset_environment()
+            case "m":
+                self.dump_metrics()
             case _:
                 self.add_pressed_keys("NOOP")
 
@@ -391,6 +720,8 @@ class Server:
         Returns:
             Union[None, bool]: False if closing, None otherwise
         """
+        from pynput import keyboard
+
         match self.get_key(key):
             case keyboard.Key.up:
                 self.remove_pressed_keys("up")
@@ -411,34 +742,48 @@ class Server:
             case _:
                 self.remove_pressed_keys("NOOP")
 
-    def add_pressed_keys(self, key: str) -> None:
-        """Add pressed keys to the list. Remove duplicates and sort for correct mapping.
+    def add_pressed_keys(self, key: str, source: str = "keyboard") -> None:
+        """Press a key. The press is stamped, so its latency can be traced until it is displayed.
 
         Args:
             key (str): key string
+            source (str, optional): input source. Defaults to "keyboard".
         """
-        self.pressed_keys.append(key)
-        self.pressed_keys = list(set(self.pressed_keys))
-        self.pressed_keys.sort()
+        with self.metrics.measure("press"):
+            self.inputs.press(key, source)
 
-    def remove_pressed_keys(self, key: str) -> None:
-        """Remove pressed keys from the list.
+    def remove_pressed_keys(self, key: str, source: str = "keyboard") -> None:
+        """Release a key.
 
         Args:
             key (str): key string
+            source (str, optional): input source. Defaults to "keyboard".
         """
-        try:
-            self.pressed_keys.remove(key)
-        except ValueError:
-            pass
+        with self.metrics.measure("release"):
+            self.inputs.release(key, source)
 
     def get_action_from_pressed_keys(self) -> int:
-        """Get action from pressed keys.
+        """Get action from pressed keys, or the next action of the agent replay.
 
         Returns:
             int: Action from ACTIONS_MAPPING dictionary, 0 otherwise
         """
-        return ACTIONS_MAPPING.get(tuple(self.pressed_keys), 0)
+        if not self.human:
+            if self.agent_finished():
+                return 0
+            return self.agent_actions[self.agent_index]
+        return self.inputs.action()
+
+    def take_trace(self) -> Union[None, dict[str, float]]:
+        """Take the stamp of the oldest keypress since the last step.
+
+        Returns:
+            Union[None, dict[str, float]]: trace with the "pressed" time, None if no keypress
+        """
+        presses = [event.timestamp for event in self.inputs.drain() if event.pressed]
+        if len(presses) == 0:
+            return None
+        return {"pressed": presses[0]}
 
     ##################### GYM RELATED #####################
     def start_recording(self) -> None:
@@ -447,7 +792,7 @@ class Server:
             os.makedirs(self.root_dir)
             self.episode = 0
         else:
-            episodes = [int(f) for f in listdir(self.root_dir) if ".pkl" not in f]
+            episodes = [int(f) for f in listdir(self.root_dir) if f.isdigit()]
             if len(episodes) == 0:
                 self.episode = 0
             else:
@@ -459,59 +804,159 @@ class Server:
             with open(f"{self.root_dir}status.pkl", "rb") as status:
                 self.status = pickle.load(status)
 
+        self.status = recover_recordings(self.root_dir, self.status)
+        self.save_status()
+
     def render_frame(self) -> None:
         """Render the frame."""
         while not self.closing:
-            self.app.update_image(self.frame)
+            with self.metrics.measure("tk_update"):
+                self.app.update_image(self.frame)
 
     def step(self) -> None:
-        """Step through the environment."""
+        """Step through the environment.
+        Each action is repeated for `action_repeat` frames. Every frame is still rendered
+        and paced, but viewers get (and recordings keep) one action per decision.
+        """
+        if not self.wait_environment():
+            return
         while not self.closing:
+            if self.agent_finished():
+                time.sleep(self.timeout)
+                continue
             try:
                 action = self.get_action_from_pressed_keys()
-
-                self.frame, reward, done, truncated, info = self.environment.step(action)
-                done |= truncated
-                self.done = done
-                if self.connection_type == Connection.ACTION:
-                    self.action_queue.put(action)
-
-                if self.record:
+                trace = self.take_trace()
+
+                resets = self.resets
+                stepped = 0
+                for repeat in range(self.action_repeat):
+                    if repeat > 0:
+                        time.sleep(self.timeout)
+                    with self.state_lock:
+                        if self.resets != resets:
+                            break
+                        checkpoint = None
+                        if (
+                            repeat == 0
+                            and self.connection_type == Connection.ACTION
+                            and len(self.history) % self.CHECKPOINT_INTERVAL == 0
+                        ):
+                            checkpoint = (len(self.history), state_checksum(self.environment))
+
+                        with self.metrics.measure("emulator_step"):
+                            self.frame, reward, done, truncated, info = self.environment.step(action)
+                        self.frames += 1
+                        stepped += 1
+                        if repeat == 0:
+                            self.publish_action(action, trace, checkpoint)
+                            if not self.human:
+                                self.agent_index += 1
+                        done |= truncated or self.agent_finished()
+                        self.done = done
+                    if done:
+                        break
+
+                if self.record and self.human and stepped > 0:
+                    flags = 0
                     if done and info["flag_get"]:
+                        flags = DONE | FLAG_GET
                         self.status[self.episode] = True
                         self.save_status()
                     elif done:
+                        flags = DONE
                         self.status[self.episode] = False
                         self.save_status()
 
                     self.save_image()
                     self.actions.append(action)
+                    self.journal.append(self.timestep, action, flags)
                     self.timestep += 1
             except ValueError:
-                if self.record:
+                # agent games are not recorded, there is no episode folder to close
+                if self.record and self.human:
                     self.save_actions()
-                self.episode += 1
+                    if self.journal is not None:
+                        self.journal.close()
+                        self.journal = None
+                    self.episode += 1
                 self.timestep = 0
             time.sleep(self.timeout)
 
+    def publish_action(
+        self,
+        action: int,
+        trace: Union[None, dict[str, float]],
+        checkpoint: Union[None, tuple[int, int]]
+    ) -> None:
+        """Hand a new decision to the viewers. Must hold the state lock.
+
+        Args:
+            action (int): action of the decision
+            trace (Union[None, dict[str, float]]): trace of the keypress, if any
+            checkpoint (Union[None, tuple[int, int]]): timestep and checksum before the decision
+        """
+        if trace is not None:
+            trace["stepped"] = time.monotonic()
+            self.tracer.record("input", trace["stepped"] - trace["pressed"])
+
+        if self.connection_type == Connection.ACTION:
+            data = {"action": action, "timestep": len(self.history) + 1}
+            if checkpoint is not None:
+                self.checkpoint = checkpoint
+                data["checksum"] = checkpoint[1]
+            self.history.append(action)
+            for viewer in self.viewers:
+                if trace is None:
+                    viewer.action_queue.put(dict(data))
+                else:
+                    viewer.action_queue.put({**data, "trace": dict(trace)})
+        elif trace is not None:
+            self.frame_trace = trace
+
+    def reset_environment(self) -> None:
+        """Reset the environment, the actions since the last reset and the action queues.
+        An agent replay starts over."""
+        with self.state_lock:
+            self.frame = self.environment.reset()
+            self.frames += 1
+            self.agent_index = 0
+            self.resets += 1
+            self.history = bytearray()
+            self.checkpoint = (0, state_checksum(self.environment))
+            if self.connection_type == Connection.ACTION:
+                for viewer in self.viewers:
+                    viewer.action_queue = Queue()
+
     def reset(self) -> None:
         """Reset the environment."""
-        self.frame = self.environment.reset()
+        self.reset_environment()
         self.done = False
 
-        if self.connection_type == Connection.ACTION:
-            self.action_queue = Queue()
-
-        if self.record:
+        if self.record and self.human:
             if not os.path.exists(f"{self.root_dir}{self.episode}/"):
                 os.makedirs(f"{self.root_dir}{self.episode}")
             self.save_image()
+            self.save_metadata()
             self.actions = []
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = ActionJournal(f"{self.root_dir}{self.episode}/actions.journal")
 
     def save_image(self) -> None:
         """Save the state image."""
-        Image.fromarray(self.frame).save(
-            f"{self.root_dir}{self.episode}/{self.timestep}.png")
+        with self.metrics.measure("png_save"):
+            Image.fromarray(self.frame).save(
+                f"{self.root_dir}{self.episode}/{self.timestep}.png")
+
+    def save_metadata(self) -> None:
+        """Save the player session and the action repeat of the episode."""
+        metadata = {
+            "session": f"{self.session}-{self.connections}",
+            "action_repeat": self.action_repeat,
+        }
+        with open(f"{self.root_dir}{self.episode}/meta.json", "w") as f:
+            json.dump(metadata, f)
 
     def save_actions(self) -> None:
         """Save the actions."""
@@ -519,40 +964,22 @@ class Server:
             pickle.dump(self.actions, f)
 
     def save_status(self) -> None:
-        """Save the status (got to the end or died)."""
-        with open(f"{self.root_dir}status.pkl", "wb") as f:
+        """Save the status (got to the end or died). Replaces the file atomically."""
+        with open(f"{self.root_dir}status.pkl.tmp", "wb") as f:
             pickle.dump(self.status, f)
+        os.replace(f"{self.root_dir}status.pkl.tmp", f"{self.root_dir}status.pkl")
 
     def verify_data(self) -> None:
-        """Verify the data and delete the corrupted ones."""
-        to_be_deleted = []
-        folders = list(next(os.walk(f"{self.root_dir}")))[1]
-        for folder in folders:
-            if not os.path.exists(f"{self.root_dir}{folder}/action.pkl"):
-                print(f"Deleting: {self.root_dir}{folder} - no action found")
-                shutil.rmtree(f"{self.root_dir}{folder}")
-                to_be_deleted.append(int(folder))
-                continue
-
-            with open(f"{self.root_dir}{folder}/action.pkl", "rb") as f:
-                actions = pickle.load(f)
-                images = [
-                    f for f in listdir(f"{self.root_dir}{folder}")
-                    if "pkl" not in f
-                ]
-                if len(actions) != len(images):
-                    print(f"Deleting: {self.root_dir}{folder} - length mismatch")
-                    shutil.rmtree(f"{self.root_dir}{folder}")
-                    to_be_deleted.append(int(folder))
-                    continue
-
-        status = {}
-        for key, value in self.status.items():
-            if key not in to_be_deleted:
-                status[key] = value
-        self.status = status
+        """Recover crashed episodes, verify new or changed ones and delete the corrupted ones.
+        Updates the episode index afterwards."""
+        self.status = recover_recordings(self.root_dir, self.status)
+        self.status = verify_recordings(self.root_dir, self.status)
         self.save_status()
 
+        index = EpisodeIndex(self.root_dir)
+        index.update()
+        index.close()
+
 
 if __name__ == "__main__":
     server = Server(record=False)
@@ -0,0 +1,310 @@
+"""Module for hosting many sessions (games) on one machine.
+
+Each session is a headless `Server` (its own environment, player, viewers and
+recordings folder) running in its own process, restarted by the manager when it
+exits unexpectedly. The manager is the only listening socket, on the usual
+`HOST`/`PORT`: a viewer sends `{"action": "join", "session": <name>}` and the
+manager hands its socket over to that session's process through a pipe, so the
+viewer keeps talking on the same connection (see `Client(session=...)`).
+Sessions are configured in a JSON list of `SessionConfig` fields:
+
+    python sessions.py --config sessions.json
+    python sessions.py --sessions 4 --player random --max-viewers 2
+"""
+from multiprocessing.connection import Connection as Pipe
+from multiprocessing.reduction import send_handle
+from typing import NamedTuple, Union
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from server import Server
+
+
+class SessionConfig(NamedTuple):
+    """Configuration of a session.
+
+    Parameters:
+        name (str): name viewers join with
+        env_name (str): gym environment name
+        player (str): "human", "agent" or "random"
+        joystick (Union[None, int]): index of the player's joypad, None for no joypad
+        keyboard (bool): whether the player uses this machine's keyboard
+        window (bool): whether to show the player window
+        record (bool): whether to record the experience
+        root_dir (Union[None, str]): recordings folder, None for "./tmp/sessions/<name>/"
+        action_repeat (int): frames each action is repeated for
+        max_viewers (int): viewers allowed at the same time
+        memory (Union[None, int]): address space limit of the session in bytes
+        nice (int): niceness added to the session process
+    """
+    name: str
+    env_name: str = "SuperMarioBros-1-1-v0"
+    player: str = "random"
+    joystick: Union[None, int] = None
+    keyboard: bool = False
+    window: bool = False
+    record: bool = False
+    root_dir: Union[None, str] = None
+    action_repeat: int = 1
+    max_viewers: int = 4
+    memory: Union[None, int] = None
+    nice: int = 0
+
+
+def apply_limits(config: SessionConfig) -> None:
+    """Limit the resources of the current (session) process. Unix only, ignored elsewhere.
+
+    Args:
+        config (SessionConfig): session configuration
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+
+    if config.memory is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (config.memory, config.memory))
+    if config.nice != 0:
+        os.nice(config.nice)
+
+
+def check_inputs(configs: list[SessionConfig]) -> None:
+    """Check that every session a human may play has its own input.
+
+    Args:
+        configs (list[SessionConfig]): session configurations
+
+    Raises:
+        ValueError: if a "human" or "random" session has no joypad nor keyboard, or an
+            input is shared by several sessions
+    """
+    joysticks = [config.joystick for config in configs if config.joystick is not None]
+    if len(joysticks) != len(set(joysticks)):
+        raise ValueError("Every joypad can only be used by one session")
+    if sum(config.keyboard for config in configs) > 1:
+        raise ValueError("The keyboard can only be used by one session")
+    for config in configs:
+        if config.player != "agent" and config.joystick is None and not config.keyboard:
+            raise ValueError(
+                f"Session {config.name} may be played by a human but has no joypad nor keyboard"
+            )
+
+
+def run_session(config: SessionConfig, handoff: Pipe) -> None:
+    """Run a session until terminated. Target of the session processes.
+    Returns when the session closes normally; a session whose server thread crashed
+    exits with status 1, so the manager restarts it.
+
+    Args:
+        config (SessionConfig): session configuration
+        handoff (Pipe): pipe the manager hands the viewers' sockets over through
+    """
+    apply_limits(config)
+    print(f"Session {config.name} started")
+    root_dir = config.root_dir
+    if root_dir is None:
+        root_dir = f"./tmp/sessions/{config.name}/"
+    try:
+        Server(
+            config.env_name,
+            record=config.record,
+            action_repeat=config.action_repeat,
+            player=config.player,
+            joystick=config.joystick,
+            keyboard_input=config.keyboard,
+            window=config.window,
+            max_viewers=config.max_viewers,
+            root_dir=root_dir,
+            handoff=handoff,
+        )
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+
+
+class SessionManager:
+    """Runs each session in its own process, restarts the ones that exit unexpectedly
+    and hands the viewers' connections over to them.
+
+    Parameters:
+        POLL_INTERVAL: Seconds between checks of the session processes.
+        STOP_TIMEOUT: Seconds a session gets to close (and verify its recordings) when stopped.
+
+        configs (dict[str, SessionConfig]): sessions by name
+        host (str): address to listen on
+        port (int): port viewers join through
+        pipes (dict[str, tuple[Pipe, Pipe]]): manager and session ends of the pipe each
+            session gets its viewers through, kept across restarts
+        processes (dict[str, multiprocessing.Process]): process running each session
+        closing (bool): whether the manager is closing
+        lock (threading.Lock): keeps `processes` and `closing` consistent between the
+            supervisor and `close`
+    """
+
+    POLL_INTERVAL = 1.0
+    STOP_TIMEOUT = 30.0
+
+    def __init__(self, configs: list[SessionConfig], host: str = Server.HOST, port: int = Server.PORT):
+        """Session manager.
+
+        Args:
+            configs (list[SessionConfig]): session configurations
+            host (str, optional): address to listen on. Defaults to Server.HOST.
+            port (int, optional): port viewers join through. Defaults to Server.PORT.
+
+        Raises:
+            ValueError: if a session has no player input, see `check_inputs`
+        """
+        check_inputs(configs)
+        self.configs = {config.name: config for config in configs}
+        self.host = host
+        self.port = port
+        self.processes = {}
+        self.closing = False
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+        self.pipes = {name: self.context.Pipe() for name in self.configs}
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def start(self) -> None:
+        """Start every session in its own process and supervise them in the background."""
+        for name in self.configs:
+            self.start_session(name)
+        thread = threading.Thread(target=self.supervise, name="supervise", daemon=True)
+        thread.start()
+
+    def start_session(self, name: str) -> None:
+        """Start (or restart) a session.
+
+        Args:
+            name (str): session name
+        """
+        process = self.context.Process(
+            target=run_session,
+            args=(self.configs[name], self.pipes[name][1]),
+            name=f"session-{name}"
+        )
+        process.start()
+        self.processes[name] = process
+
+    def supervise(self) -> None:
+        """Restart the sessions that exit with an error, are killed (e.g. out of memory)
+        or lose a server thread, until the manager closes."""
+        while not self.closing:
+            time.sleep(self.POLL_INTERVAL)
+            with self.lock:
+                for name, process in list(self.processes.items()):
+                    if self.closing or process.is_alive():
+                        continue
+                    if process.exitcode == 0:
+                        print(f"Session {name} closed")
+                        del self.processes[name]
+                        continue
+                    print(f"Session {name} stopped with exit code {process.exitcode}, restarting")
+                    self.start_session(name)
+
+    def route(self, conn: socket.socket) -> None:
+        """Answer the first request of a viewer: hand the connection over to the session it
+        joins, or answer with the list of sessions or an error and close it.
+
+        Args:
+            conn (socket.socket): connection to the viewer
+        """
+        try:
+            data = json.loads(conn.recv(Server.BUFFER_SIZE).decode())
+        except (OSError, json.JSONDecodeError):
+            conn.close()
+            return
+
+        name = data.get("session")
+        with self.lock:
+            process = self.processes.get(name)
+        match data.get("action", ""):
+            case "join" if process is not None and process.is_alive():
+                try:
+                    conn.send(json.dumps({"status": "joined"}).encode())
+                    # the session gets the same (blocking) socket, the manager's copy is closed
+                    conn.settimeout(None)
+                    send_handle(self.pipes[name][0], conn.fileno(), process.pid)
+                except OSError as e:
+                    print(f"Could not hand a viewer over to session {name}: {e!r}")
+                conn.close()
+                return
+            case "join" if name in self.configs:
+                response = {"error": f"session {name} is restarting"}
+            case "join":
+                response = {"error": f"unknown session {name}"}
+            case "list":
+                response = {"sessions": list(self.configs)}
+            case _:
+                response = {}
+        try:
+            conn.send(json.dumps(response).encode())
+        except OSError:
+            pass
+        conn.close()
+
+    def serve(self) -> None:
+        """Route viewers until interrupted, then stop the sessions."""
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.s.bind((self.host, self.port))
+        self.s.listen()
+        print(f"Routing {len(self.configs)} sessions on {self.host} at {self.port}")
+        try:
+            while True:
+                conn, _ = self.s.accept()
+                conn.settimeout(2)
+                self.route(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the sessions (they verify their recordings on SIGTERM) and the listener."""
+        with self.lock:
+            self.closing = True
+            processes = dict(self.processes)
+        for process in processes.values():
+            process.terminate()
+        for name, process in processes.items():
+            process.join(self.STOP_TIMEOUT)
+            if process.is_alive():
+                print(f"Session {name} did not stop, killing it")
+                process.kill()
+                process.join()
+        self.s.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host many sessions on one machine.")
+    parser.add_argument("--config", default=None, help="JSON list of SessionConfig fields")
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--player", default="random", choices=["human", "agent", "random"])
+    parser.add_argument("--max-viewers", type=int, default=4)
+    parser.add_argument("--host", default=Server.HOST)
+    parser.add_argument("--port", type=int, default=Server.PORT)
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config, "r") as f:
+            configs = [SessionConfig(**config) for config in json.load(f)]
+    else:
+        configs = [
+            SessionConfig(
+                f"booth-{i}",
+                player=args.player,
+                joystick=None if args.player == "agent" else i,
+                max_viewers=args.max_viewers
+            )
+            for i in range(args.sessions)
+        ]
+
+    manager = SessionManager(configs, args.host, args.port)
+    manager.start()
+    manager.serve()
@@ -0,0 +1,174 @@
+"""Module for adapting the FRAME-mode stream to the viewer's connection.
+
+Every frame is sent as one message: the length of a small JSON header, the
+header and the zlib-compressed pixels, so the server never waits on the viewer
+between the header and the pixels. With its next request the viewer reports how
+long it waited for the frame; minus the time the server spent serving it, that is
+what the connection cost, and it decides the quality: when the viewer falls
+behind, frames are sent downscaled and compressed harder, and the quality is
+raised again once the connection keeps up. (The bytes queued in the socket are
+not used: with one frame in flight they only measure the size of that frame.)
+"""
+from typing import Union
+import json
+import struct
+import zlib
+
+import numpy as np
+
+
+# (downscale factor, zlib level) from best to cheapest
+LEVELS = ((1, 1), (1, 6), (2, 6), (3, 9))
+# length of the JSON header of a message
+HEADER = struct.Struct("!I")
+
+
+def pack_message(header: dict[str, any], payload: bytes = b"") -> bytes:
+    """Pack a FRAME-mode message: the header length, the JSON header and the payload.
+
+    Args:
+        header (dict[str, any]): header, with the payload length if there is a payload
+        payload (bytes, optional): compressed pixels. Defaults to b"".
+
+    Returns:
+        bytes: message
+    """
+    header = json.dumps(header).encode()
+    return HEADER.pack(len(header)) + header + payload
+
+
+def decode_frame(payload: bytes, info: dict[str, int]) -> np.ndarray:
+    """Decode a frame sent by `FrameStreamer`, upscaled back to its original size.
+
+    Args:
+        payload (bytes): compressed pixels
+        info (dict[str, int]): height, width, channels and scale of the frame
+
+    Returns:
+        np.ndarray: frame
+    """
+    h, w, c = info["height"], info["width"], info["channels"]
+    scale = info.get("scale", 1)
+    frame = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    frame = frame.reshape((-(-h // scale), -(-w // scale), c))
+    if scale > 1:
+        frame = frame.repeat(scale, axis=0).repeat(scale, axis=1)[:h, :w]
+    return frame
+
+
+class FrameStreamer:
+    """Encodes frames for one viewer at the quality its connection keeps up with.
+
+    Parameters:
+        interval (float): seconds between frames on the server, the time budget per frame
+        patience (int): frames in a row within budget before the quality rises
+        smoothing (float): weight of the newest measurement in the moving average
+        level (int): current index in `LEVELS`
+        network (float): smoothed seconds the viewer waited for a frame beyond the time the
+            server spent serving it (round trip and transfer)
+        served (float): seconds the server spent serving the last frame, None before the first
+        calm (int): frames in a row within budget
+        last_frame (int): server frame number of the last frame sent
+        skipped (int): frames stepped by the server that were never sent
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        patience: int = 30,
+        smoothing: float = 0.2
+    ):
+        """Frame streamer.
+
+        Args:
+            interval (float): seconds between frames on the server
+            patience (int, optional): frames within budget before raising quality. Defaults to 30.
+            smoothing (float, optional): weight of the newest measurement. Defaults to 0.2.
+        """
+        self.interval = interval
+        self.patience = patience
+        self.smoothing = smoothing
+        self.level = 0
+        self.network = 0.0
+        self.served = None
+        self.calm = 0
+        self.last_frame = None
+        self.skipped = 0
+
+    def is_stale(self, frame_number: int) -> bool:
+        """Whether the frame was already sent to the viewer.
+
+        Args:
+            frame_number (int): server frame number
+
+        Returns:
+            bool: True if the viewer already has it
+        """
+        return frame_number == self.last_frame
+
+    def encode(self, frame: np.ndarray, frame_number: int) -> tuple[bytes, dict[str, int]]:
+        """Encode a frame at the current quality.
+
+        Args:
+            frame (np.ndarray): frame
+            frame_number (int): server frame number, to count the skipped frames
+
+        Returns:
+            tuple[bytes, dict[str, int]]: compressed pixels and the info for `decode_frame`
+        """
+        if self.last_frame is not None:
+            self.skipped += max(frame_number - self.last_frame - 1, 0)
+        self.last_frame = frame_number
+
+        h, w, c = frame.shape
+        scale, compression = LEVELS[self.level]
+        pixels = np.ascontiguousarray(frame[::scale, ::scale], dtype=np.uint8)
+        info = {"height": h, "width": w, "channels": c, "scale": scale}
+        return zlib.compress(pixels.tobytes(), compression), info
+
+    def sent(self, served: float) -> None:
+        """Record the server side of the frame just sent.
+
+        Args:
+            served (float): seconds between the viewer's request and the frame being sent
+        """
+        self.served = served
+
+    def update(self, fetch: Union[None, float]) -> Union[None, int]:
+        """Adapt the quality once the viewer reports how long it waited for the last frame.
+
+        Args:
+            fetch (Union[None, float]): seconds between the viewer's request and having the
+                whole frame, None if the viewer did not get a frame yet
+
+        Returns:
+            Union[None, int]: new level, if it changed
+        """
+        if fetch is None or self.served is None:
+            return None
+        network = max(fetch - self.served, 0.0)
+        self.network += self.smoothing * (network - self.network)
+        cost = self.network
+
+        level = self.level
+        if cost > 2 * self.interval:
+            self.calm = 0
+            level = min(self.level + 1, len(LEVELS) - 1)
+        elif cost < self.interval / 2:
+            self.calm += 1
+            if self.calm >= self.patience:
+                self.calm = 0
+                level = max(self.level - 1, 0)
+        else:
+            self.calm = 0
+
+        if level == self.level:
+            return None
+        print(
+            f"Stream level {level} {LEVELS[level]}: network {self.network * 1000:.1f}ms, "
+            f"skipped {self.skipped}"
+        )
+        self.level = level
+        # measure the new level from scratch, so one slow frame does not drop several levels
+        self.network = 0.0
+        return level
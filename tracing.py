@@ -0,0 +1,123 @@
+"""Module for tracing the input-to-display latency of the experience."""
+from collections import defaultdict, deque
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class LatencyTracer:
+    """Collects per stage latencies and keeps a histogram for each of them.
+
+    Stages are free-form names (e.g. "input", "queue", "network", "emulate",
+    "display", "total"). Every sample is also kept in a bounded window, so the
+    percentiles reflect the recent behaviour.
+
+    Parameters:
+        BUCKETS: upper bounds (ms) of the histogram buckets.
+
+        name (str): name used when logging and exporting.
+        log_every (float): seconds between summaries printed to the console.
+        histograms (dict): bucket counts per stage.
+        samples (dict): recent samples (ms) per stage.
+    """
+
+    BUCKETS = [1, 2, 4, 8, 16, 25, 33, 50, 66, 100, 133, 200, 500, 1000, np.inf]
+
+    def __init__(self, name: str, log_every: float = 10.0, window: int = 10000):
+        """Latency tracer.
+
+        Args:
+            name (str): name used when logging and exporting.
+            log_every (float, optional): seconds between summaries, disabled if None.
+                Defaults to 10.0.
+            window (int, optional): amount of samples kept per stage. Defaults to 10000.
+        """
+        self.name = name
+        self.log_every = log_every
+        self.histograms = defaultdict(lambda: [0] * len(self.BUCKETS))
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+        self.last_log = time.monotonic()
+
+    def record(self, stage: str, seconds: float) -> None:
+        """Record a latency sample.
+
+        Args:
+            stage (str): stage name
+            seconds (float): latency in seconds
+        """
+        milliseconds = seconds * 1000
+        bucket = int(np.searchsorted(self.BUCKETS, milliseconds))
+        with self.lock:
+            self.histograms[stage][bucket] += 1
+            self.samples[stage].append(milliseconds)
+
+        if self.log_every is not None and time.monotonic() - self.last_log > self.log_every:
+            self.last_log = time.monotonic()
+            self.log()
+
+    def summary(self) -> dict[str, dict[str, any]]:
+        """Summarise all stages.
+
+        Returns:
+            dict[str, dict[str, any]]: count, mean, p50, p99, max and histogram per stage
+        """
+        summary = {}
+        with self.lock:
+            for stage, samples in self.samples.items():
+                samples = np.array(samples)
+                summary[stage] = {
+                    "count": int(sum(self.histograms[stage])),
+                    "mean_ms": float(samples.mean()),
+                    "p50_ms": float(np.percentile(samples, 50)),
+                    "p99_ms": float(np.percentile(samples, 99)),
+                    "max_ms": float(samples.max()),
+                    "buckets_ms": [str(bucket) for bucket in self.BUCKETS],
+                    "histogram": list(self.histograms[stage]),
+                }
+        return summary
+
+    def log(self) -> None:
+        """Print a one line summary per stage."""
+        for stage, values in self.summary().items():
+            print(
+                f"[{self.name}] {stage}: n={values['count']} "
+                f"p50={values['p50_ms']:.1f}ms p99={values['p99_ms']:.1f}ms "
+                f"max={values['max_ms']:.1f}ms"
+            )
+
+    def export(self, path: str = "./tmp/latency/") -> None:
+        """Export the summary as JSON.
+
+        Args:
+            path (str, optional): folder for the report. Defaults to "./tmp/latency/".
+        """
+        summary = self.summary()
+        if len(summary) == 0:
+            return
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        with open(os.path.join(path, f"{self.name}-{timestamp}.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+def estimate_offset(t0: float, remote: float, t1: float) -> float:
+    """Estimate the offset between a remote and the local monotonic clock.
+
+    Assumes the remote stamp was taken halfway through the round trip.
+
+    Args:
+        t0 (float): local time when the request was sent
+        remote (float): remote time in the reply
+        t1 (float): local time when the reply arrived
+
+    Returns:
+        float: remote - local
+    """
+    return remote - (t0 + t1) / 2
@@ -1,4 +1,6 @@
 from functools import partial
+import argparse
+import json
 import pickle
 from os import listdir
 import os
@@ -12,36 +14,39 @@ except ImportError:
     from typing_extensions import Self
 
 from benchmark.methods import BC
-import gym
-import gym_super_mario_bros
-from nes_py.wrappers import JoypadSpace
-from gymnasium.wrappers import StepAPICompatibility, TimeLimit
 from PIL import Image
 import torch
+import torch.distributed as dist
 from tqdm import tqdm
 from torch import Tensor
-from torch.utils.data import DataLoader, Dataset
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, WeightedRandomSampler
 from torchvision import transforms
 import numpy as np
 from tensorboard_wrapper.tensorboard import Tensorboard
 
 
-from utils import ACTIONS
+import dedup
+from episode_index import EpisodeIndex
+from utils import create_environment, subsample_step
 
 
-def create_env() -> gym.Env:
-    env = gym.make("SuperMarioBros-1-1-v0")
-    steps = env._max_episode_steps
+def average_metrics(metrics: dict[str, float]) -> dict[str, float]:
+    """Average the metrics of an epoch across ranks (no-op if not distributed).
 
-    env = JoypadSpace(env.env, ACTIONS)
-
-    def gymnasium_reset(self, **kwargs):
-        return self.env.reset()
-    env.reset = gymnasium_reset.__get__(env, JoypadSpace)
+    Args:
+        metrics (dict[str, float]): metrics of this rank
 
-    env = StepAPICompatibility(env, output_truncation_bool=True)
-    env = TimeLimit(env, max_episode_steps=steps)
-    return env
+    Returns:
+        dict[str, float]: metrics averaged over all ranks
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return metrics
+    names = sorted(metrics)
+    values = torch.tensor([float(metrics[name]) for name in names], dtype=torch.float64)
+    dist.all_reduce(values)
+    values /= dist.get_world_size()
+    return dict(zip(names, values.tolist()))
 
 
 def train(
@@ -52,34 +57,46 @@ def train(
     always_save: bool = False,
 ) -> Self:
     """Train process.
+    If torch.distributed is initialised, gradients are averaged across ranks and only
+    rank 0 logs and checkpoints (with the metrics averaged across ranks).
 
     Args:
         n_epochs (int): amount of epoch to run.
-        train_dataset (DataLoader): data to train.
+        train_dataset (DataLoader): data to train (this rank's shard).
         eval_dataset (DataLoader): data to eval. Defaults to None.
 
     Returns:
         method (Self): trained method.
     """
-    folder = f"./benchmark_results/bc/{self.environment_name}"
-    if not os.path.exists(folder):
-        os.makedirs(f"{folder}/")
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+
+    board = None
+    if rank == 0:
+        folder = f"./benchmark_results/bc/{self.environment_name}"
+        if not os.path.exists(folder):
+            os.makedirs(f"{folder}/")
 
-    board = Tensorboard(path=folder)
-    board.add_hparams(self.hyperparameters)
+        board = Tensorboard(path=folder)
+        board.add_hparams(self.hyperparameters)
     self.policy.to(self.device)
+    if distributed:
+        self.policy = DistributedDataParallel(self.policy)
 
     best_model = -np.inf
 
     pbar = range(n_epochs)
-    if self.verbose:
+    if self.verbose and rank == 0:
         pbar = tqdm(pbar, desc=self.__method_name__)
     for epoch in pbar:
-        train_metrics = self._train(train_dataset)
-        board.add_scalars("Train", epoch="train", **train_metrics)
+        train_metrics = average_metrics(self._train(train_dataset))
+        if eval_dataset is not None:
+            eval_metrics = average_metrics(self._eval(eval_dataset))
+        if rank != 0:
+            continue
 
+        board.add_scalars("Train", epoch="train", **train_metrics)
         if eval_dataset is not None:
-            eval_metrics = self._eval(eval_dataset)
             board.add_scalars("Eval", epoch="eval", **eval_metrics)
             board.step(["train", "eval"])
         else:
@@ -87,19 +104,81 @@ def train(
 
         if train_metrics["accuracy"] >= best_model:
             best_model = train_metrics["accuracy"]
+            # checkpoint the policy itself, not its DistributedDataParallel wrapper
+            policy, self.policy = self.policy, getattr(self.policy, "module", self.policy)
             self.save(name=epoch if always_save else None)
+            self.policy = policy
 
+    if distributed:
+        self.policy = self.policy.module
     return self
 
 
+def shard_episodes(lengths: dict[any, int], rank: int, world_size: int) -> list[any]:
+    """Split episodes across ranks with about the same amount of frames each.
+    Longest episodes first, each to the rank with the fewest frames so far.
+
+    Args:
+        lengths (dict[any, int]): length of each episode
+        rank (int): rank of this process
+        world_size (int): amount of ranks
+
+    Returns:
+        list[any]: episodes of this rank
+    """
+    shards = [[] for _ in range(world_size)]
+    totals = [0] * world_size
+    for episode, length in sorted(lengths.items(), key=lambda item: (-item[1], str(item[0]))):
+        lightest = totals.index(min(totals))
+        shards[lightest].append(episode)
+        totals[lightest] += length
+    if len(shards[rank]) == 0:
+        raise ValueError(f"Rank {rank} has no episodes, use at most {len(lengths)} processes")
+    return sorted(shards[rank], key=str)
+
+
 class MarioDataset(Dataset):
     def __init__(
         self,
         path: str,
-        transform: Callable[[Tensor], Tensor] = None
+        transform: Callable[[Tensor], Tensor] = None,
+        query: dict[str, any] = None,
+        action_repeat: int = 1,
+        deduplicate: bool = False,
+        shard: tuple[int, int] = None
     ) -> None:
+        """Dataset with the recorded frames and actions.
+
+        Args:
+            path (str): episode folder, list of episode folders or, with a query, the
+                recordings root.
+            transform (Callable[[Tensor], Tensor], optional): frame transform. Defaults to None.
+            query (dict[str, any], optional): filters for the episode index (e.g.
+                {"success": True, "min_length": 500}), see `EpisodeIndex.where`. Defaults to None.
+            action_repeat (int, optional): frames per decision of the agent. Episodes recorded
+                with a smaller action repeat are subsampled to match, see `subsample_step`; it
+                must be a multiple of every episode's recorded action repeat. Defaults to 1.
+            deduplicate (bool, optional): collapse runs of near-duplicate frames with the same
+                action, see `dedup.deduplicate`. The run lengths are kept in `weights` for
+                `sampler`. Defaults to False.
+            shard (tuple[int, int], optional): rank and world size, to keep only this rank's
+                episodes (see `shard_episodes`). Defaults to None (all episodes).
+        """
         self.path = path
-        if isinstance(path, list):
+        self.action_repeat = action_repeat
+        self.shard = shard
+        if shard is not None and query is None:
+            paths = path if isinstance(path, list) else [path]
+            lengths = {}
+            for p in paths:
+                with open(f"{p}action.pkl", "rb") as f:
+                    lengths[p] = len(pickle.load(f))
+            path = shard_episodes(lengths, *shard)
+
+        hashes = None
+        if query is not None:
+            self.states, self.actions, hashes = self.load_query(path, query)
+        elif isinstance(path, list):
             self.states, self.actions = self.load_data(path[0])
             for p in path[1:]:
                 states, actions = self.load_data(p)
@@ -108,22 +187,66 @@ class MarioDataset(Dataset):
         else:
             self.states, self.actions = self.load_data(path)
 
+        self.weights = None
+        if deduplicate:
+            if hashes is None:
+                hashes = dedup.hash_frames(self.states)
+            length = len(self.states)
+            self.states, actions, self.weights = dedup.deduplicate(
+                self.states,
+                self.actions.tolist(),
+                hashes
+            )
+            self.actions = torch.tensor(actions)
+            print(f"Deduplicated {length} frames into {len(self.states)}")
+
         self.transform = transform
         if transform is None:
             self.transform = transforms.Compose([
                 transforms.ToTensor(),
             ])
 
+    def load_query(self, path: str, query: dict[str, any]) -> tuple[list[str], Tensor, list[int]]:
+        index = EpisodeIndex(path)
+        if len(index.select()) == 0:
+            index.update()
+        if self.shard is not None:
+            query = {**query, "episodes": shard_episodes(index.lengths(**query), *self.shard)}
+        states, actions, hashes = index.samples(self.action_repeat, **query)
+        index.close()
+        return states, torch.tensor(actions), hashes
+
     def load_data(self, path: str) -> tuple[Tensor, Tensor]:
         actions = pickle.load(open(f"{path}action.pkl", "rb"))
         actions = torch.tensor(actions)
         images = [join(path, f) for f in listdir(path) if "png" in f]
         images.sort(key=lambda x: int(x.split("/")[-1].split(".")[0]))
-        return images, actions
+
+        recorded_repeat = 1
+        if os.path.exists(f"{path}meta.json"):
+            with open(f"{path}meta.json", "r") as f:
+                recorded_repeat = json.load(f).get("action_repeat", 1)
+        step = subsample_step(recorded_repeat, self.action_repeat)
+        return images[::step], actions[::step]
 
     def __len__(self) -> int:
         return self.actions.size(0)
 
+    def sampler(self, num_samples: int = None) -> WeightedRandomSampler:
+        """Sampler that draws each frame proportionally to the duplicates it stands for,
+        so a deduplicated dataset keeps the action distribution of the recordings.
+
+        Args:
+            num_samples (int, optional): draws per epoch, the same on every rank when
+                distributed. Defaults to None (one per kept frame).
+
+        Returns:
+            WeightedRandomSampler: sampler for the DataLoader
+        """
+        weights = [1] * len(self) if self.weights is None else self.weights
+        num_samples = len(self) if num_samples is None else num_samples
+        return WeightedRandomSampler(weights, num_samples=num_samples, replacement=True)
+
     def __getitem__(self, idx: int) -> tuple[Tensor, Tensor]:
         state = self.states[idx]
         action = torch.tensor([self.actions[idx]])
@@ -133,26 +256,95 @@ class MarioDataset(Dataset):
         return state, action, torch.tensor([])
 
 
-if __name__ == "__main__":
-    dataset = MarioDataset([
-        "./tmp/recordings/1/",
-        "./tmp/recordings/4/",
-        "./tmp/recordings/5/",
-        "./tmp/recordings/6/",
-        "./tmp/recordings/8/",
-        "./tmp/recordings/12/",
-        "./tmp/recordings/13/",
-        "./tmp/recordings/14/",
-        "./tmp/recordings/15/",
-        "./tmp/recordings/16/",
-    ])
-    dataloader = DataLoader(dataset, shuffle=True, batch_size=4)
-
-    env = create_env()
-    bc = BC(env, config_file="./bc.yaml", verbose=True, enjoy_criteria=999999)
+EPISODES = [
+    "./tmp/recordings/1/",
+    "./tmp/recordings/4/",
+    "./tmp/recordings/5/",
+    "./tmp/recordings/6/",
+    "./tmp/recordings/8/",
+    "./tmp/recordings/12/",
+    "./tmp/recordings/13/",
+    "./tmp/recordings/14/",
+    "./tmp/recordings/15/",
+    "./tmp/recordings/16/",
+]
+
+
+def main(args: argparse.Namespace) -> None:
+    """Train BC on the recordings, distributed if launched by torchrun or `--nproc`.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    """
+    distributed = "RANK" in os.environ
+    shard = None
+    if distributed:
+        dist.init_process_group("gloo")
+        shard = (dist.get_rank(), dist.get_world_size())
+        # one share of the cores per process on the node, instead of all of them each
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", shard[1]))
+        torch.set_num_threads(max(os.cpu_count() // local_world_size, 1))
+
+    dataset = MarioDataset(EPISODES, deduplicate=args.deduplicate, shard=shard)
+    if distributed or args.deduplicate:
+        num_samples = len(dataset)
+        if distributed:
+            # every rank must run the same amount of steps per epoch
+            count = torch.tensor([num_samples])
+            dist.all_reduce(count, op=dist.ReduceOp.MIN)
+            num_samples = int(count)
+        dataloader = DataLoader(
+            dataset,
+            sampler=dataset.sampler(num_samples),
+            batch_size=args.batch_size
+        )
+    else:
+        dataloader = DataLoader(dataset, shuffle=True, batch_size=args.batch_size)
+
+    env = create_environment("SuperMarioBros-1-1-v0")
+    bc = BC(env, config_file="./bc.yaml", verbose=shard is None or shard[0] == 0, enjoy_criteria=999999)
     bc.train = types.MethodType(train, bc)
 
     bc.train(
-        n_epochs=200,
+        n_epochs=args.epochs,
         train_dataset=dataloader
     )
+
+    if distributed:
+        dist.destroy_process_group()
+
+
+def spawn_worker(rank: int, args: argparse.Namespace) -> None:
+    """Run one rank of a local distributed training (`--nproc`).
+
+    Args:
+        rank (int): rank of this process
+        args (argparse.Namespace): command line arguments
+    """
+    os.environ.update({
+        "RANK": str(rank),
+        "WORLD_SIZE": str(args.nproc),
+        "LOCAL_WORLD_SIZE": str(args.nproc),
+        "MASTER_ADDR": "127.0.0.1",
+        "MASTER_PORT": str(args.port),
+    })
+    main(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train BC on the recordings.")
+    parser.add_argument("--epochs", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=4, help="per process")
+    parser.add_argument("--nproc", type=int, default=1, help="local processes (distributed)")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="collapse near-duplicate frames and sample the rest by weight"
+    )
+    args = parser.parse_args()
+
+    if args.nproc > 1:
+        torch.multiprocessing.spawn(spawn_worker, args=(args,), nprocs=args.nproc)
+    else:
+        main(args)
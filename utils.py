@@ -1,11 +1,11 @@
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable
 import functools
+import subprocess
+import zlib
 from enum import Enum
 
-import gym
-import gym_super_mario_bros
-from nes_py.wrappers import JoypadSpace
-from gymnasium.wrappers import StepAPICompatibility, TimeLimit
+if TYPE_CHECKING:
+    import gym
 
 
 class Connection(Enum):
@@ -72,8 +72,11 @@ def ignore_unhashable(func: Callable[Any, tuple]) -> tuple[int]:
     return wrapper
 
 
-def create_environment(env_name: str) -> gym.Env:
+def create_environment(env_name: str) -> "gym.Env":
     """Create the gym environment.
+    The emulator packages are imported here, so importing this module stays cheap.
+    nes_py keeps a backup of the emulator after the start screen, so `reset` restores
+    it instead of replaying the start screen.
 
     Args:
         env_name (str): gym environment name
@@ -81,6 +84,11 @@ def create_environment(env_name: str) -> gym.Env:
     Returns:
         gym.Env: gym environment
     """
+    import gym
+    import gym_super_mario_bros  # noqa: F401 (registers the environments)
+    from gymnasium.wrappers import StepAPICompatibility, TimeLimit
+    from nes_py.wrappers import JoypadSpace
+
     env = gym.make(env_name)
     steps = env._max_episode_steps
 
@@ -93,3 +101,52 @@ def create_environment(env_name: str) -> gym.Env:
     env = StepAPICompatibility(env, output_truncation_bool=True)
     env = TimeLimit(env, max_episode_steps=steps)
     return env
+
+
+def state_checksum(env: "gym.Env") -> int:
+    """Checksum of the emulator RAM.
+    Equal on every machine that stepped the same actions since the reset.
+
+    Args:
+        env (gym.Env): environment created by create_environment
+
+    Returns:
+        int: CRC32 of the RAM
+    """
+    return zlib.crc32(env.unwrapped.ram.tobytes())
+
+
+def subsample_step(recorded_repeat: int, action_repeat: int) -> int:
+    """Recorded decisions per decision at a coarser action repeat.
+    Shared by every loader of the recordings, so they keep the same frames.
+
+    Args:
+        recorded_repeat (int): frames each action was repeated for when recorded
+        action_repeat (int): frames per decision to train on
+
+    Raises:
+        ValueError: if the action repeat is not a multiple of the recorded one
+
+    Returns:
+        int: keep every `step`-th recorded decision
+    """
+    if action_repeat % recorded_repeat != 0:
+        raise ValueError(
+            f"Action repeat {action_repeat} is not a multiple of the recorded {recorded_repeat}"
+        )
+    return action_repeat // recorded_repeat
+
+
+def get_commit() -> str:
+    """Get the current git commit, used to label benchmark reports.
+
+    Returns:
+        str: short commit hash or "unknown"
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,165 @@
+"""Module for verifying the recordings.
+
+Keeps a manifest (`manifest.pkl` under the recordings root) with the counts,
+checksum and verification time of each episode, so only new or changed
+episodes are checked. Can also be run on its own, which first recovers the
+episodes left without `action.pkl` from their action journal:
+
+    python verify.py --root ./tmp/recordings/ --workers 4
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from os import listdir
+from typing import Union
+import argparse
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+
+from journal import recover_recordings
+
+
+def episode_signature(folder: str) -> tuple[int, ...]:
+    """Cheap signature of an episode, changes whenever its files change.
+
+    Args:
+        folder (str): episode folder
+
+    Returns:
+        tuple[int, ...]: folder mtime, and action.pkl mtime and size if it exists
+    """
+    signature = (os.stat(folder).st_mtime_ns, )
+    action = os.path.join(folder, "action.pkl")
+    if os.path.exists(action):
+        stat = os.stat(action)
+        signature += (stat.st_mtime_ns, stat.st_size)
+    return signature
+
+
+def verify_episode(folder: str) -> dict[str, any]:
+    """Verify that an episode has as many actions as frames.
+
+    Args:
+        folder (str): episode folder
+
+    Returns:
+        dict[str, any]: manifest entry, with "valid" and "reason" for the caller
+    """
+    entry = {"signature": episode_signature(folder)}
+    action = os.path.join(folder, "action.pkl")
+    if not os.path.exists(action):
+        return {**entry, "valid": False, "reason": "no action found"}
+
+    with open(action, "rb") as f:
+        data = f.read()
+    try:
+        actions = pickle.loads(data)
+    except (pickle.UnpicklingError, EOFError):
+        return {**entry, "valid": False, "reason": "corrupted actions"}
+
+    frames = sorted(f for f in listdir(folder) if "png" in f)
+    checksum = hashlib.sha1(data)
+    checksum.update("\n".join(frames).encode())
+    entry.update({
+        "actions": len(actions),
+        "frames": len(frames),
+        "checksum": checksum.hexdigest(),
+        "verified_at": datetime.now().isoformat(),
+    })
+    if len(actions) != len(frames):
+        return {**entry, "valid": False, "reason": "length mismatch"}
+    return {**entry, "valid": True, "reason": None}
+
+
+def load_manifest(root_dir: str) -> dict[str, dict[str, any]]:
+    """Load the manifest of the recordings.
+
+    Args:
+        root_dir (str): root directory for the recordings
+
+    Returns:
+        dict[str, dict[str, any]]: manifest entry per episode folder
+    """
+    if not os.path.exists(f"{root_dir}manifest.pkl"):
+        return {}
+    with open(f"{root_dir}manifest.pkl", "rb") as f:
+        return pickle.load(f)
+
+
+def save_manifest(root_dir: str, manifest: dict[str, dict[str, any]]) -> None:
+    """Save the manifest of the recordings.
+
+    Args:
+        root_dir (str): root directory for the recordings
+        manifest (dict[str, dict[str, any]]): manifest entry per episode folder
+    """
+    with open(f"{root_dir}manifest.pkl", "wb") as f:
+        pickle.dump(manifest, f)
+
+
+def verify_recordings(
+    root_dir: str,
+    status: dict[int, bool],
+    workers: Union[None, int] = None
+) -> dict[int, bool]:
+    """Verify new or changed episodes in parallel and delete the corrupted ones.
+
+    Args:
+        root_dir (str): root directory for the recordings
+        status (dict[int, bool]): status of each episode
+        workers (Union[None, int], optional): amount of worker processes. Defaults to None (CPUs).
+
+    Returns:
+        dict[int, bool]: status without the deleted episodes
+    """
+    manifest = load_manifest(root_dir)
+    # episodes only, other folders (e.g. sessions) are not recordings of this root
+    folders = [folder for folder in list(next(os.walk(f"{root_dir}")))[1] if folder.isdigit()]
+    pending = [
+        folder for folder in folders
+        if manifest.get(folder, {}).get("signature") != episode_signature(f"{root_dir}{folder}")
+    ]
+
+    results = []
+    if len(pending) > 0:
+        # spawned, not forked: the server calls this from a process with Tk and input threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(verify_episode, [f"{root_dir}{folder}" for folder in pending]))
+
+    to_be_deleted = []
+    for folder, entry in zip(pending, results):
+        if not entry.pop("valid"):
+            print(f"Deleting: {root_dir}{folder} - {entry.pop('reason')}")
+            shutil.rmtree(f"{root_dir}{folder}")
+            to_be_deleted.append(int(folder))
+            continue
+        entry.pop("reason")
+        manifest[folder] = entry
+
+    manifest = {
+        folder: entry for folder, entry in manifest.items()
+        if os.path.exists(f"{root_dir}{folder}")
+    }
+    save_manifest(root_dir, manifest)
+    print(f"Verified {len(pending)} of {len(folders)} episodes, deleted {len(to_be_deleted)}")
+
+    return {key: value for key, value in status.items() if key not in to_be_deleted}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify the recordings.")
+    parser.add_argument("--root", default="./tmp/recordings/")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    status = {}
+    if os.path.exists(f"{args.root}status.pkl"):
+        with open(f"{args.root}status.pkl", "rb") as f:
+            status = pickle.load(f)
+
+    status = recover_recordings(args.root, status)
+    status = verify_recordings(args.root, status, args.workers)
+    with open(f"{args.root}status.pkl", "wb") as f:
+        pickle.dump(status, f)